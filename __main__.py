@@ -0,0 +1,40 @@
+import argparse
+
+from .watch import DeckWatcher
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog="python -m pybeamer")
+  commands = parser.add_subparsers(dest="command", required=True)
+  watch = commands.add_parser(
+      "watch", help="rebuild a deck whenever its script or inputs change")
+  watch.add_argument("script", help="the script building and generating the deck")
+  watch.add_argument("--cache-dir", default=None,
+                     help="where compiled frames are kept "
+                          "(default: .pybeamer-cache next to the script)")
+  watch.add_argument("--compiler", default=None)
+  watch.add_argument("--jobs", type=int, default=None,
+                     help="compile up to this many frames at a time")
+  watch.add_argument("--precompile-preamble", action="store_true")
+  watch.add_argument("--externalize", action="store_true")
+  watch.add_argument("--interval", type=float, default=0.5,
+                     help="seconds between checks for changes")
+  watch.add_argument("--once", action="store_true",
+                     help="build once and exit instead of watching")
+  args = parser.parse_args(argv)
+
+  watcher = DeckWatcher(args.script, cache_dir=args.cache_dir,
+                        compiler=args.compiler, jobs=args.jobs,
+                        precompile_preamble=args.precompile_preamble,
+                        externalize=args.externalize, interval=args.interval)
+  if args.once:
+    watcher.build()
+  else:
+    try:
+      watcher.watch()
+    except KeyboardInterrupt:
+      pass
+
+
+if __name__ == "__main__":
+  main()
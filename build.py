@@ -0,0 +1,555 @@
+import atexit
+import hashlib
+import itertools
+import os
+import re
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from pylatex.errors import CompilerError
+
+# Helpers to compile a deck piece by piece, instead of handing the
+# whole document to pylatex in one go
+
+## Files LaTeX leaves behind next to a compiled job
+AUXILIARY_EXTENSIONS = ["aux", "log", "nav", "out", "snm", "toc", "vrb"]
+
+## Files a LaTeX pass writes and the next pass reads back
+RERUN_EXTENSIONS = ["aux", "nav", "out", "snm", "toc"]
+
+## The initex engine and base format behind each LaTeX compiler,
+## used to dump a preamble into a format of its own
+FORMAT_ENGINES = {
+    "pdflatex": ("pdftex", "pdflatex"),
+    "xelatex": ("xetex", "xelatex"),
+    "lualatex": ("luatex", "lualatex"),
+}
+
+## Overlay commands and specifications, including mode specifications,
+## which render differently in a handout
+_OVERLAYS = re.compile(
+    r"\\(onslide|pause|only|uncover|visible|invisible|alt|temporal|mode)\b"
+    r"|<[0-9+.][^<>]*>|<(beamer|handout|presentation|article)\b")
+
+## Pictures with overlay specifications or referring to other pictures
+## render differently depending on where they appear
+_PICTURE_NOT_EXTERNALIZABLE = re.compile(
+    _OVERLAYS.pattern + r"|remember picture|overlay")
+
+
+def has_overlays(tex):
+  return _OVERLAYS.search(tex) is not None
+
+
+class LaTeXError(CompilerError):
+  """
+  A compiler run that failed, with everything it printed in output,
+  and its first error in the message.
+  """
+
+  def __init__(self, command, returncode, output):
+    self.command = command
+    self.returncode = returncode
+    self.output = output.decode(errors="replace") \
+        if isinstance(output, bytes) else output
+    errors = [line for line in self.output.splitlines() if line.startswith("!")]
+    super(LaTeXError, self).__init__("%s exited with %d%s" % (
+        " ".join(command), returncode,
+        (": %s" % errors[0]) if len(errors) > 0 else ""))
+
+  @classmethod
+  def from_process_error(cls, e):
+    return cls(e.cmd, e.returncode, e.output or b"")
+
+
+def content_hash(*parts):
+  digest = hashlib.sha256()
+  for part in parts:
+    digest.update(part.encode("utf-8"))
+    digest.update(b"\0")
+  return digest.hexdigest()[:32]
+
+
+def compiler_command(compiler=None, compiler_args=None):
+  compiler = "pdflatex" if compiler is None else compiler
+  command = [compiler]
+  if compiler == "latexmk":
+    command.append("--pdf")
+  command += ["--interaction=nonstopmode", "--halt-on-error"]
+  if compiler_args is not None:
+    command += compiler_args
+  return command
+
+
+def input_env(directories):
+  """
+  The environment for compiling outside the directories where the deck
+  finds its inputs, such as images, with them first in TEXINPUTS.
+  None when there are none.
+  """
+  if not directories:
+    return None
+  env = dict(os.environ)
+  ## The empty entry that ends the list stands for TeX's own paths
+  env["TEXINPUTS"] = os.pathsep.join(
+      [os.path.abspath(directory) for directory in directories] +
+      [os.environ.get("TEXINPUTS", "")])
+  return env
+
+
+def run_latex(source, jobname, workdir, compiler=None, compiler_args=None,
+              env=None, timeout=None):
+  """Write source to workdir/jobname.tex, compile it and return the pdf path."""
+  with open(os.path.join(workdir, jobname + ".tex"), "w", encoding="utf-8") as f:
+    f.write(source)
+  return latex_pass(jobname, workdir, compiler, compiler_args, env, timeout)
+
+
+def latex_pass(jobname, workdir, compiler=None, compiler_args=None, env=None,
+               timeout=None):
+  """
+  Compile workdir/jobname.tex once and return the pdf path. env is the
+  environment of the compiler, see input_env. A compiler running for
+  longer than timeout seconds is killed.
+  """
+  command = compiler_command(compiler, compiler_args) + [jobname + ".tex"]
+  try:
+    subprocess.check_output(command, stderr=subprocess.STDOUT, cwd=workdir,
+                            env=env, timeout=timeout)
+  except FileNotFoundError:
+    raise CompilerError("LaTeX compiler %s was not found" % command[0])
+  except subprocess.TimeoutExpired:
+    raise CompilerError("Compiling %s took more than %s seconds" %
+                        (jobname, timeout))
+  except subprocess.CalledProcessError as e:
+    raise LaTeXError.from_process_error(e) from e
+  return os.path.join(workdir, jobname + ".pdf")
+
+
+def rerun_state(workdir, jobname):
+  state = []
+  for ext in RERUN_EXTENSIONS:
+    try:
+      with open(os.path.join(workdir, "%s.%s" % (jobname, ext)), "rb") as f:
+        state.append(hashlib.sha256(f.read()).hexdigest())
+    except FileNotFoundError:
+      state.append(None)
+  return state
+
+
+def compile_until_stable(jobname, workdir, compiler=None, compiler_args=None,
+                         max_passes=5, env=None):
+  """
+  Compile workdir/jobname.tex until the files read back between passes
+  (see RERUN_EXTENSIONS) stop changing, and return the number of passes.
+  Such files left by an earlier build are the starting point, so a
+  build that changed no heading, label or frame count takes one pass.
+  """
+  if compiler == "latexmk":
+    ## latexmk reruns by itself
+    latex_pass(jobname, workdir, compiler, compiler_args, env)
+    return 1
+  state = rerun_state(workdir, jobname)
+  for i in range(max_passes):
+    latex_pass(jobname, workdir, compiler, compiler_args, env)
+    previous, state = state, rerun_state(workdir, jobname)
+    if state == previous:
+      return i + 1
+  return max_passes
+
+
+def dump_format(preamble, jobname, workdir, compiler=None, env=None):
+  """
+  Dump the preamble into workdir/jobname.fmt with mylatexformat.
+  A document compiled with -fmt=jobname skips its own preamble up to
+  \\begin{document} and starts from the dumped state instead.
+  """
+  compiler = "pdflatex" if compiler is None else compiler
+  if compiler not in FORMAT_ENGINES:
+    raise ValueError("Cannot precompile a preamble for %s" % compiler)
+  engine, base = FORMAT_ENGINES[compiler]
+  with open(os.path.join(workdir, jobname + ".tex"), "w", encoding="utf-8") as f:
+    f.write(preamble + "\\begin{document}\n\\end{document}\n")
+  command = [engine, "-ini", "--interaction=nonstopmode", "--halt-on-error",
+             "-jobname=%s" % jobname, "&%s" % base, "mylatexformat.ltx",
+             jobname + ".tex"]
+  try:
+    subprocess.check_output(command, stderr=subprocess.STDOUT, cwd=workdir,
+                            env=env)
+  except FileNotFoundError:
+    raise CompilerError("TeX engine %s was not found" % engine)
+  except subprocess.CalledProcessError as e:
+    raise LaTeXError.from_process_error(e) from e
+  return os.path.join(workdir, jobname + ".fmt")
+
+
+def remove_auxiliary(workdir, jobname, keep_tex=False):
+  extensions = list(AUXILIARY_EXTENSIONS)
+  if not keep_tex:
+    extensions.append("tex")
+  for ext in extensions:
+    try:
+      os.remove(os.path.join(workdir, "%s.%s" % (jobname, ext)))
+    except FileNotFoundError:
+      pass
+
+
+class TeXWorker(object):
+  """
+  A compiler process started ahead of time on a preamble, which loads
+  it and then waits at \\input /dev/stdin for the rest of a document
+  to be piped in. Each worker compiles a single document.
+  """
+
+  def __init__(self, workdir, jobname, preamble, compiler=None, compiler_args=None,
+               env=None):
+    self.workdir = workdir
+    self.jobname = jobname
+    with open(self.path("tex"), "w", encoding="utf-8") as f:
+      ## The primitive \\input, as LaTeX's would open the pipe to test it
+      f.write(preamble + "\\csname @@input\\endcsname /dev/stdin \n")
+    self.command = compiler_command(compiler, compiler_args) + [jobname + ".tex"]
+    ## The output goes to a file: a pipe nobody reads before the job
+    ## arrives would fill up and stall the compiler. Not .out, which
+    ## hyperref writes its bookmarks to.
+    self.output = open(self.path("stdout"), "wb")
+    try:
+      self.process = subprocess.Popen(
+          self.command, cwd=workdir, stdin=subprocess.PIPE,
+          stdout=self.output, stderr=subprocess.STDOUT, env=env)
+    except FileNotFoundError:
+      self.output.close()
+      raise CompilerError("LaTeX compiler %s was not found" % self.command[0])
+
+  def path(self, ext):
+    return os.path.join(self.workdir, "%s.%s" % (self.jobname, ext))
+
+  def alive(self):
+    return self.process.poll() is None
+
+  def run(self, body, timeout=None):
+    """
+    Compile the preamble followed by body, and return the pdf path.
+    Raises OSError if the worker died before or was killed by a signal,
+    TimeoutExpired if piping body in and compiling took more than
+    timeout seconds, and CalledProcessError if compiling failed.
+    """
+    try:
+      self.process.communicate(body.encode("utf-8"), timeout=timeout)
+    except subprocess.TimeoutExpired:
+      self.close()
+      raise
+    finally:
+      self.output.close()
+    if self.process.returncode < 0:
+      raise ChildProcessError("%s was killed by signal %d" % (
+          self.command[0], -self.process.returncode))
+    if self.process.returncode != 0:
+      with open(self.path("stdout"), "rb") as f:
+        output = f.read()
+      raise subprocess.CalledProcessError(
+          self.process.returncode, self.command, output)
+    return self.path("pdf")
+
+  def close(self):
+    if self.alive():
+      self.process.kill()
+      self.process.wait()
+    for stream in [self.process.stdin, self.output]:
+      try:
+        stream.close()
+      except OSError:
+        pass
+
+  def clean(self):
+    remove_auxiliary(self.workdir, self.jobname)
+    for ext in ["stdout", "pdf"]:
+      try:
+        os.remove(self.path(ext))
+      except FileNotFoundError:
+        pass
+
+
+class WorkerPool(object):
+  """
+  Keeps size TeXWorkers started on a preamble and ready to compile the
+  documents that start with it. A worker is replaced by a fresh one as
+  soon as it is taken. A worker that runs for longer than timeout
+  seconds is killed. Documents fall back to a normal compile, with the
+  same timeout, when their worker died, was killed or timed out.
+  """
+
+  ## Pools shared by builds in the same process, see shared
+  _pools = {}
+  _counter = itertools.count()
+
+  def __init__(self, workdir, preamble, size, compiler=None,
+               compiler_args=None, timeout=None, env=None):
+    if not os.path.exists("/dev/stdin"):
+      raise ValueError("TeX workers need /dev/stdin")
+    if compiler is not None and compiler not in FORMAT_ENGINES:
+      raise ValueError("Cannot run %s as a TeX worker" % compiler)
+    self.workdir = workdir
+    self.preamble = preamble
+    self.size = size
+    self.compiler = compiler
+    self.compiler_args = compiler_args
+    self.timeout = timeout
+    self.env = env
+    self.lock = threading.Lock()
+    self.idle = []
+    with self.lock:
+      self.fill()
+
+  @classmethod
+  def shared(cls, workdir, preamble, size, compiler=None, compiler_args=None,
+             timeout=None, env=None):
+    """A pool kept warm for later builds with the same preamble."""
+    key = (workdir, preamble, str(compiler), tuple(compiler_args or []),
+           None if env is None else env.get("TEXINPUTS"))
+    pool = cls._pools.get(key)
+    if pool is None:
+      pool = cls._pools[key] = cls(workdir, preamble, size, compiler,
+                                   compiler_args, timeout, env)
+    pool.size, pool.timeout = max(pool.size, size), timeout
+    return pool
+
+  def fill(self):
+    ## Called with the lock held
+    while len(self.idle) < self.size:
+      self.idle.append(TeXWorker(
+          self.workdir, "worker-%d-%d" % (os.getpid(), next(self._counter)),
+          self.preamble, self.compiler, self.compiler_args, self.env))
+
+  def take(self):
+    with self.lock:
+      worker = None
+      while len(self.idle) > 0 and worker is None:
+        worker = self.idle.pop(0)
+        if not worker.alive():
+          ## Crashed or killed while waiting
+          worker.close()
+          worker.clean()
+          worker = None
+      self.fill()
+      return worker
+
+  def compile(self, source, jobname, inputs=None):
+    """
+    Compile source, which starts with the preamble, into
+    workdir/jobname.pdf. inputs are copied as in FrameCache.compile.
+    """
+    if not source.startswith(self.preamble):
+      raise ValueError("Source does not start with the pool's preamble")
+    worker = self.take()
+    if worker is None:
+      return self.compile_cold(source, jobname, inputs)
+    try:
+      if inputs is not None:
+        for ext, path in inputs.items():
+          shutil.copyfile(path, worker.path(ext))
+      try:
+        if not worker.alive():
+          raise BrokenPipeError()
+        pdf = worker.run(source[len(self.preamble):], self.timeout)
+      except (OSError, subprocess.TimeoutExpired):
+        ## The worker died, was killed or got stuck
+        return self.compile_cold(source, jobname, inputs)
+      except subprocess.CalledProcessError as e:
+        raise LaTeXError.from_process_error(e) from e
+      os.replace(pdf, os.path.join(self.workdir, jobname + ".pdf"))
+      return os.path.join(self.workdir, jobname + ".pdf")
+    finally:
+      worker.close()
+      worker.clean()
+
+  def compile_cold(self, source, jobname, inputs=None):
+    if inputs is not None:
+      for ext, path in inputs.items():
+        shutil.copyfile(path, os.path.join(self.workdir, "%s.%s" % (jobname, ext)))
+    try:
+      return run_latex(source, jobname, self.workdir, self.compiler,
+                       self.compiler_args, self.env, self.timeout)
+    finally:
+      remove_auxiliary(self.workdir, jobname)
+
+  def close(self):
+    with self.lock:
+      for worker in self.idle:
+        worker.close()
+        worker.clean()
+      self.idle = []
+
+  @classmethod
+  def close_all(cls, workdir=None):
+    """Close the shared pools, or only those working in workdir."""
+    for key, pool in list(cls._pools.items()):
+      if workdir is None or pool.workdir == workdir:
+        pool.close()
+        del cls._pools[key]
+
+
+atexit.register(WorkerPool.close_all)
+
+
+class FrameCache(object):
+  """
+  A directory of compiled pieces of a deck, each stored as <key>.pdf
+  where the key is the content hash of the tex it was compiled from.
+  A piece is only compiled when no pdf exists for its key yet. Relative
+  inputs, such as images, are looked up in input_dirs, e.g. the
+  directory of the deck, as if compiled there.
+  """
+
+  def __init__(self, cache_dir, compiler=None, compiler_args=None,
+               input_dirs=None):
+    self.cache_dir = os.path.abspath(cache_dir)
+    self.compiler = compiler
+    self.compiler_args = compiler_args
+    self.env = input_env(input_dirs)
+    self.format_args = []
+    self.pool = None
+    os.makedirs(self.cache_dir, exist_ok=True)
+
+  def path(self, key, ext="pdf"):
+    return os.path.join(self.cache_dir, "%s.%s" % (key, ext))
+
+  def has(self, key, ext="pdf"):
+    return os.path.exists(self.path(key, ext))
+
+  def args(self, formatted):
+    args = list(self.compiler_args) if self.compiler_args is not None else []
+    if formatted:
+      args += self.format_args
+    return args
+
+  def use_format(self, preamble):
+    """
+    Compile the pieces of the deck against a format with the preamble
+    dumped in it, dumping it first if this preamble has none yet.
+    """
+    key = content_hash("format", str(self.compiler), preamble)
+    if not self.has(key, "fmt"):
+      try:
+        dump_format(preamble, key, self.cache_dir, compiler=self.compiler,
+                    env=self.env)
+      finally:
+        remove_auxiliary(self.cache_dir, key)
+    self.format_args = ["-fmt=%s" % key]
+
+  def use_workers(self, preamble, size, timeout=None):
+    """
+    Compile the pieces that start with the preamble on warm TeX workers,
+    kept for later builds in this process too. Workers load the preamble
+    themselves and do not use the format of use_format.
+    """
+    ## A format skips its preamble up to \begin{document}, which a
+    ## worker only reads from stdin once a job arrives
+    self.pool = WorkerPool.shared(self.cache_dir, preamble, size,
+                                  compiler=self.compiler,
+                                  compiler_args=self.args(False),
+                                  timeout=timeout, env=self.env)
+
+  def compile(self, key, source, inputs=None, formatted=True):
+    """
+    Compile source under the given key unless it is already cached.
+    inputs maps extensions to files copied next to the job before
+    compiling, e.g. {"toc": path} to provide a table of contents.
+    Sources that do not share the deck preamble pass formatted=False.
+    """
+    if self.has(key):
+      return self.path(key)
+    if formatted and self.pool is not None and \
+       source.startswith(self.pool.preamble):
+      return self.pool.compile(source, key, inputs)
+    if inputs is not None:
+      for ext, path in inputs.items():
+        shutil.copyfile(path, self.path(key, ext))
+    try:
+      run_latex(source, key, self.cache_dir, compiler=self.compiler,
+                compiler_args=self.args(formatted), env=self.env)
+    finally:
+      remove_auxiliary(self.cache_dir, key)
+    return self.path(key)
+
+  def compile_all(self, pieces, jobs=None, formatted=True):
+    """
+    Compile a list of (key, source, inputs), up to jobs at a time.
+    Each compile is a separate compiler process, so threads are
+    enough to keep that many processes busy.
+    """
+    todo = {}
+    for key, source, inputs in pieces:
+      if not self.has(key):
+        todo[key] = (source, inputs)
+    if jobs is None or jobs <= 1 or len(todo) <= 1:
+      for key, (source, inputs) in todo.items():
+        self.compile(key, source, inputs, formatted)
+      return
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+      futures = [pool.submit(self.compile, key, source, inputs, formatted)
+                 for key, (source, inputs) in todo.items()]
+      for future in futures:
+        future.result()
+
+  def compile_auxiliary(self, key, source, ext):
+    """Compile source only for the auxiliary file it writes, e.g. toc."""
+    if self.has(key, ext):
+      return self.path(key, ext)
+    run_latex(source, key, self.cache_dir, compiler=self.compiler,
+              compiler_args=self.args(True), env=self.env)
+    for other in AUXILIARY_EXTENSIONS + ["tex", "pdf"]:
+      if other != ext and self.has(key, other):
+        os.remove(self.path(key, other))
+    return self.path(key, ext)
+
+  def merge(self, keys, filepath):
+    """Concatenate the cached pdfs of keys into filepath.pdf."""
+    if len(keys) == 0:
+      raise ValueError("Nothing to merge")
+    key = content_hash("merge", *keys)
+    if not self.has(key):
+      lines = ["\\documentclass{article}", "\\usepackage{pdfpages}",
+               "\\begin{document}"]
+      for k in keys:
+        lines.append("\\includepdf[pages=-,fitpaper]{%s.pdf}" % k)
+      lines.append("\\end{document}")
+      self.compile(key, "\n".join(lines) + "\n", formatted=False)
+    shutil.copyfile(self.path(key), os.path.abspath(filepath) + ".pdf")
+
+
+class PictureExternalizer(object):
+  """
+  Replaces tikz pictures by graphics compiled once into a FrameCache,
+  each keyed by the hash of the standalone document it compiles from.
+  Pictures are compiled by compile(), after all of them are collected.
+  carried is the content outside frames in effect where the next
+  pictures are, such as \\newcommand or \\definecolor, which goes into
+  their documents too.
+  """
+
+  def __init__(self, cache, preamble):
+    self.cache = cache
+    self.preamble = preamble
+    self.carried = ""
+    self.pending = {}
+
+  def include(self, tex):
+    if _PICTURE_NOT_EXTERNALIZABLE.search(tex) is not None:
+      return tex
+    source = "".join([
+        self.preamble, "\\begin{document}%\n", self.carried,
+        "\\begin{standaloneframe}%\n",
+        tex, "%\n\\end{standaloneframe}%\n\\end{document}\n"])
+    key = content_hash(source)
+    if not self.cache.has(key):
+      self.pending[key] = source
+    return "\\includegraphics{%s}" % self.cache.path(key).replace(os.sep, "/")
+
+  def compile(self, jobs=None):
+    self.cache.compile_all(
+        [(key, source, None) for key, source in self.pending.items()],
+        jobs, formatted=False)
+    self.pending = {}
@@ -1,60 +1,191 @@
+import os
 import re
 import math
+import hashlib
+import numbers
+import bisect
+from types import MappingProxyType
 
 # An alternative tool to generate tikz code in builder mode
+#
+# The output is canonical: the same calls give byte-identical tikz code
+# in every process. Options keep the order they were set in (switches
+# are kept in a dict used as an ordered set, since iterating a set of
+# strings changes with hash randomization), numbers go through
+# format_number, and handles are numbered in creation order per canvas.
+
+def format_number(value):
+  """Fixed-point with trailing zeros dropped and no negative zero."""
+  ret = ("%.6f" % value).rstrip("0").rstrip(".")
+  return "0" if ret == "-0" else ret
+
+def format_numbers(values):
+  """format_number over a whole NumPy array, returns a list of strings."""
+  ## After rounding, repr gives the same digits much faster, except
+  ## where it switches to an exponent. Adding 0.0 drops negative zeros.
+  ret = []
+  for value in (values.round(6) + 0.0).tolist():
+    if value.is_integer():
+      ret.append("%d" % value)
+    else:
+      text = repr(value)
+      ret.append(text if "e" not in text else format_number(value))
+  return ret
+
+## Most items carry no options or only a couple of them, so the set and
+## dict are only allocated on the first set(). Until then these shared
+## empty ones stand in, and they are never modified.
+_NO_SWITCHES = MappingProxyType({})
+_NO_PROPERTIES = MappingProxyType({})
+_NO_HIDDEN = frozenset()
 
 ## Alternative to TikZOptions, not use *args and **kwargs
 ## because in tikz, options may contain spaces, inconvenient
 ## to handle in python
 class DrawOptions:
-  def __init__(self):
-    self.switches = set()
-    self.properties = dict()
+  ## _dumps caches the serialized options until the next set or unset.
+  ##
+  ## style is a DrawOptions shared with other items (see share and
+  ## Builder.apply), which is never modified. The item's own switches
+  ## and properties come on top of it. Unsetting a key of the style
+  ## hides it; setting one copies the style into the item first, so
+  ## the shared storage is only copied by items that change it.
+  __slots__ = ("switches", "properties", "style", "hidden", "_dumps")
+
+  def __init__(self, style=None):
+    self.switches = _NO_SWITCHES
+    self.properties = _NO_PROPERTIES
+    self.style = style
+    self.hidden = _NO_HIDDEN
+    self._dumps = None
+
+  def in_style(self, key):
+    return self.style is not None and key not in self.hidden and \
+      (key in self.style.switches or key in self.style.properties)
+
+  def iter_switches(self):
+    if self.style is not None:
+      for key in self.style.switches:
+        if key not in self.hidden:
+          yield key
+    yield from self.switches
+
+  def iter_properties(self):
+    if self.style is not None:
+      for key, value in self.style.properties.items():
+        if key not in self.hidden:
+          yield key, value
+    yield from self.properties.items()
+
+  def materialize(self):
+    ## Copy the style into this item's own storage
+    switches = dict.fromkeys(self.iter_switches())
+    properties = dict(self.iter_properties())
+    self.switches = switches if len(switches) > 0 else _NO_SWITCHES
+    self.properties = properties if len(properties) > 0 else _NO_PROPERTIES
+    self.style = None
+    self.hidden = _NO_HIDDEN
+
+  def share(self):
+    """
+    Turn these options into a style shared with the caller, and return
+    it. The options keep the same content, now held by the style.
+    """
+    if len(self.switches) == 0 and len(self.properties) == 0 and \
+       len(self.hidden) == 0:
+      return self.style
+    if self.style is not None:
+      self.materialize()
+    style = DrawOptions()
+    style.switches, style.properties = self.switches, self.properties
+    style._dumps = self._dumps
+    self.switches, self.properties = _NO_SWITCHES, _NO_PROPERTIES
+    self.style = style
+    return style
 
   def copy(self):
-    options = DrawOptions()
-    options.switches = set(self.switches)
-    options.properties = dict(self.properties)
+    options = DrawOptions(self.share())
+    options._dumps = self._dumps
     return options
 
   def isempty(self):
-    return len(self.switches) == 0 and len(self.properties) == 0
+    return len(self) == 0
 
   def __len__(self):
-    return len(self.switches) + len(self.properties)
+    ret = len(self.switches) + len(self.properties)
+    if self.style is not None:
+      ret += len(self.style) - len(self.hidden)
+    return ret
 
   def dumps(self):
-    items = [item for item in self.switches]
-    for key in self.properties:
-      value = self.properties[key]
-      if not isinstance(value, str):
+    if self._dumps is not None:
+      return self._dumps
+    if self.style is not None and len(self.hidden) == 0 and \
+       len(self.switches) == 0 and len(self.properties) == 0:
+      ## The same string object for every item sharing the style
+      return self.style.dumps()
+    items = [item for item in self.iter_switches()]
+    cacheable = True
+    for key, value in self.iter_properties():
+      if isinstance(value, numbers.Real):
+        ## Including NumPy scalars, whose dumps() pickles them
+        value = format_number(value)
+      elif not isinstance(value, str):
+        ## Such a value may change without us knowing
         value = value.dumps()
+        cacheable = False
       items.append("%s=%s" % (key, value))
-    return ",".join(items)
+    ret = ",".join(items)
+    if cacheable:
+      self._dumps = ret
+    return ret
 
   def set(self, key, value=None):
+    self._dumps = None
+    if self.in_style(key):
+      self.materialize()
     if value is None:
-      self.switches.add(key)
+      if self.switches is _NO_SWITCHES:
+        self.switches = dict()
+      self.switches[key] = None
     else:
+      if self.properties is _NO_PROPERTIES:
+        self.properties = dict()
       self.properties[key] = value
 
   def unset(self, key):
+    self._dumps = None
     ## Usually, a switch and a key-value property will
     ## never have the same name
     if key in self.switches:
-      self.switches.remove(key)
+      self.switches.pop(key)
     elif key in self.properties:
       self.properties.pop(key)
+    elif self.in_style(key):
+      if self.hidden is _NO_HIDDEN:
+        self.hidden = set()
+      self.hidden.add(key)
 
   def isset(self, switch):
-    return switch in self.switches
+    return switch in self.switches or \
+      (self.in_style(switch) and switch in self.style.switches)
 
   def get(self, key):
-    return self.properties.get(key) # Return None when not exist
+    if key in self.properties:
+      return self.properties[key]
+    if self.in_style(key):
+      return self.style.properties.get(key)
+    return None # Return None when not exist
 
 class HasOptions(object):
+  ## _dumps caches the last serialization of the item together with
+  ## what it was built from, and is reused while those are the same
+  ## objects. The options string is the same object until set/unset.
+  __slots__ = ("options", "_dumps")
+
   def __init__(self, options=None):
     self.options = options if options is not None else DrawOptions()
+    self._dumps = None
 
   def set(self, key, value=None):
     self.options.set(key, value)
@@ -71,7 +202,20 @@ class HasOptions(object):
     return self.options.get(key)
 
 ## Alternative to TikZNode
+##
+## Memory budget, measured with tracemalloc on CPython 3.11 for nodes
+## made by Canvas.make_node and placed with set_pos((x, y)), including
+## their entries in the positions and index dicts of the canvas:
+## - about 410 bytes per node without options: the node, its empty
+##   DrawOptions, its handle string, its Coordinate and the two entries
+## - about 780 bytes per node with set_box and set_fill, most of the
+##   difference the two dicts allocated to hold the options
+## - about 410 bytes per node made through the builder, as in
+##   with_box(...).with_fill(...).make_node(), since nodes made with
+##   the same options share one style (see DrawOptions)
 class Node(HasOptions):
+  __slots__ = ("text", "at", "canvas", "handle")
+
   def __init__(self, canvas, handle):
     super(Node, self).__init__()
     self.text = ""
@@ -80,8 +224,16 @@ class Node(HasOptions):
     self.handle = handle
 
   def dumps(self):
-    return "\\node%s(%s)%s{%s};" % (
-      ("[%s]" % self.options.dumps()) if not self.options.isempty() else "",
+    options = self.options.dumps()
+    ## The node of an anchor may get another handle, see Canvas.replace
+    anchor = self.at.node.handle if isinstance(self.at, NodeAnchor) else None
+    cache = self._dumps
+    if cache is not None and cache[0] is options and cache[1] is self.text \
+       and cache[2] is self.at and cache[3] is self.handle and \
+       cache[4] is anchor:
+      return cache[5]
+    ret = "\\node%s(%s)%s{%s};" % (
+      ("[%s]" % options) if options else "",
       self.handle,
       (("at %s" % self.at) if isinstance(self.at, str) else
         ("at (%s)" % self.at.dumps() if isinstance(self.at, NodeAnchor)
@@ -89,22 +241,29 @@ class Node(HasOptions):
         if self.at is not None else "",
       self.text,
     )
+    self._dumps = (options, self.text, self.at, self.handle, anchor, ret)
+    return ret
 
   def set_text(self, text):
     self.text = text
     return self
 
   def set_pos(self, pos):
+    ## numbers.Real also takes numpy scalars, e.g. from a CoordinateArray
     if isinstance(pos, tuple) and \
-       (isinstance(pos[0], int) or isinstance(pos[0], float)) and \
-       (isinstance(pos[1], int) or isinstance(pos[1], float)):
+       isinstance(pos[0], numbers.Real) and isinstance(pos[1], numbers.Real):
       self.at = Coordinate(*pos)
+    elif isinstance(pos, CoordinateArray):
+      if len(pos) != 1:
+        raise ValueError("a node has one position, got %d" % len(pos))
+      self.at = pos[0]
     else:
       self.at = pos
     return self
 
   def set_scale(self, scale):
-    return self.set("scale", str(scale))
+    return self.set("scale", format_number(scale)
+                    if isinstance(scale, numbers.Real) else str(scale))
 
   def set_fill(self, fill):
     return self.set("fill", fill)
@@ -367,6 +526,8 @@ class Node(HasOptions):
     return self.canvas.with_arrow().connect(self, another).set_above_text(text)
 
 class NodeAnchor(object):
+  __slots__ = ("node", "horizontal", "vertical")
+
   def __init__(self, node, horizontal, vertical):
     self.node = node
     self.horizontal = horizontal
@@ -392,6 +553,8 @@ class NodeAnchor(object):
 class Coordinate(object):
   """A General Purpose Coordinate Class."""
 
+  __slots__ = ("_x", "_y", "relative")
+
   _coordinate_str_regex = re.compile(r'(\+\+)?\(\s*(-?[0-9]+(\.[0-9]+)?)\s*'
                                      r',\s*(-?[0-9]+(\.[0-9]+)?)\s*\)')
 
@@ -411,7 +574,8 @@ class Coordinate(object):
     self.relative = relative
 
   def __repr__(self):
-    return '%s(%g,%g)' % ('++' if self.relative else '', self._x, self._y)
+    return '%s(%s,%s)' % ('++' if self.relative else '',
+                          format_number(self._x), format_number(self._y))
 
   def dumps(self):
       """Return representation."""
@@ -469,12 +633,17 @@ class Coordinate(object):
                       self._y + other_coord._y)
 
   def __radd__(self, other):
-    self.__add__(other)
+    return self.__add__(other)
 
   def __sub__(self, other):
     other_coord = self._arith_check(other)
-    return ZCoordinate(self._x - other_coord._y,
-                       self._y - other_coord._y)
+    return Coordinate(self._x - other_coord._x,
+                      self._y - other_coord._y)
+
+  def __rsub__(self, other):
+    other_coord = self._arith_check(other)
+    return Coordinate(other_coord._x - self._x,
+                      other_coord._y - self._y)
 
   def distance_to(self, other):
     """Euclidean distance between two coordinates."""
@@ -483,7 +652,223 @@ class Coordinate(object):
     return math.sqrt(math.pow(self._x - other_coord._x, 2) +
                      math.pow(self._y - other_coord._y, 2))
 
+class CoordinateArray(object):
+  """
+  The absolute coordinates of many points as one (n, 2) numpy array,
+  transformed all at once instead of one Coordinate at a time.
+  Transformations return a new CoordinateArray.
+  """
+
+  __slots__ = ("xy",)
+
+  def __init__(self, xy):
+    import numpy
+    xy = numpy.asarray(xy, dtype=float)
+    if xy.ndim != 2 or xy.shape[1] != 2:
+      raise ValueError("xy should have shape (n, 2), got %s" % (xy.shape,))
+    self.xy = xy
+
+  @classmethod
+  def from_coordinates(cls, coordinates):
+    """From Coordinates or (x, y) tuples."""
+    import numpy
+    xy = []
+    for coord in coordinates:
+      if isinstance(coord, Coordinate):
+        if coord.relative:
+          raise ValueError("Coordinate should not be relative")
+        xy.append((coord._x, coord._y))
+      else:
+        xy.append(coord)
+    return cls(numpy.reshape(numpy.array(xy, dtype=float), (-1, 2)))
+
+  @property
+  def x(self):
+    return self.xy[:, 0]
+
+  @property
+  def y(self):
+    return self.xy[:, 1]
+
+  def __len__(self):
+    return len(self.xy)
+
+  def __getitem__(self, i):
+    if isinstance(i, numbers.Integral):
+      x, y = self.xy[i].tolist()
+      return Coordinate(x, y)
+    return CoordinateArray(self.xy[i])
+
+  def __iter__(self):
+    for x, y in self.xy.tolist():
+      yield Coordinate(x, y)
+
+  def __repr__(self):
+    return "CoordinateArray(%s)" % ", ".join(self.dumps_list())
+
+  def _operand(self, other):
+    ## A single point or one point per row, as something numpy broadcasts
+    import numpy
+    if isinstance(other, CoordinateArray):
+      return other.xy
+    if isinstance(other, Coordinate):
+      if other.relative:
+        raise ValueError("refusing to add relative coordinates")
+      return numpy.array([other._x, other._y])
+    other = numpy.asarray(other, dtype=float)
+    if other.shape not in [(2,), (len(self), 2)]:
+      raise TypeError("cannot combine %d points with shape %s" %
+                      (len(self), other.shape))
+    return other
+
+  def __add__(self, other):
+    return CoordinateArray(self.xy + self._operand(other))
+
+  def __radd__(self, other):
+    return self.__add__(other)
+
+  def __sub__(self, other):
+    return CoordinateArray(self.xy - self._operand(other))
+
+  def __rsub__(self, other):
+    return CoordinateArray(self._operand(other) - self.xy)
+
+  def __neg__(self):
+    return CoordinateArray(-self.xy)
+
+  def translate(self, dx, dy):
+    return self + (dx, dy)
+
+  def scale(self, sx, sy=None, origin=(0, 0)):
+    """Scale around origin, by sx in both directions unless sy is given."""
+    if sy is None:
+      sy = sx
+    origin = self._operand(origin)
+    return CoordinateArray((self.xy - origin) * (sx, sy) + origin)
+
+  def rotate(self, degrees, origin=(0, 0)):
+    """Rotate counterclockwise around origin, in degrees like tikz."""
+    import numpy
+    theta = math.radians(degrees)
+    cos, sin = math.cos(theta), math.sin(theta)
+    origin = self._operand(origin)
+    rotation = numpy.array([[cos, sin], [-sin, cos]])
+    return CoordinateArray((self.xy - origin) @ rotation + origin)
+
+  def distance_to(self, other):
+    """
+    Euclidean distances to a point, or row by row to as many points,
+    as a numpy array.
+    """
+    import numpy
+    return numpy.hypot(*(self.xy - self._operand(other)).T)
+
+  def pairwise_distances(self, other=None):
+    """The matrix of distances from every point to every point of other."""
+    import numpy
+    other = self if other is None else other
+    if not isinstance(other, CoordinateArray):
+      other = CoordinateArray(other)
+    delta = self.xy[:, None, :] - other.xy[None, :, :]
+    return numpy.hypot(delta[..., 0], delta[..., 1])
+
+  def dumps_list(self):
+    """The coordinates as tikz, e.g. ["(0,0)", "(1,2.5)"]."""
+    return ["(%s,%s)" % xy for xy in zip(format_numbers(self.xy[:, 0]),
+                                          format_numbers(self.xy[:, 1]))]
+
+def downsample_minmax(x, y, buckets):
+  """
+  Indices of the points to keep from a series sorted by x: the first
+  and last, and the lowest and highest of each of buckets equal slices
+  of the x range, so every slice spans the same y range as before.
+  """
+  import numpy
+  n = len(x)
+  if n <= 2 * buckets + 2:
+    return numpy.arange(n)
+  span = x[-1] - x[0]
+  if span > 0:
+    bucket = numpy.minimum(((x - x[0]) / span * buckets).astype(int), buckets - 1)
+  else:
+    bucket = numpy.zeros(n, dtype=int)
+  ## Sorted by bucket, then by y: each bucket starts with its lowest
+  ## point and ends with its highest
+  order = numpy.lexsort((y, bucket))
+  starts = numpy.flatnonzero(numpy.diff(bucket[order], prepend=-1))
+  ends = numpy.append(starts[1:], n) - 1
+  keep = numpy.concatenate([[0, n - 1], order[starts], order[ends]])
+  return numpy.unique(keep)
+
+def downsample_lttb(x, y, n_out):
+  """
+  Indices of n_out points chosen by Largest-Triangle-Three-Buckets:
+  the first and last, and from each bucket of the rest the point
+  spanning the largest triangle with the point kept before it and the
+  mean of the next bucket.
+  """
+  import numpy
+  n = len(x)
+  if n_out >= n:
+    return numpy.arange(n)
+  if n_out <= 2:
+    return numpy.array([0, n - 1])
+  edges = numpy.linspace(1, n - 1, n_out - 1).astype(int)
+  keep = numpy.empty(n_out, dtype=int)
+  keep[0], keep[-1] = 0, n - 1
+  a = 0
+  for i in range(n_out - 2):
+    start, end = edges[i], edges[i + 1]
+    if i + 2 < len(edges):
+      next_start, next_end = edges[i + 1], edges[i + 2]
+    else:
+      next_start, next_end = n - 1, n
+    cx = x[next_start:next_end].mean()
+    cy = y[next_start:next_end].mean()
+    areas = numpy.abs((x[a] - cx) * (y[start:end] - y[a]) -
+                      (x[a] - x[start:end]) * (cy - y[a]))
+    a = start + int(numpy.argmax(areas))
+    keep[i + 1] = a
+  return keep
+
+def write_data_file(directory, iter_lines, ext):
+  """
+  Write the lines from iter_lines() to a file in directory named by the
+  hash of its content, unless it is already there, and return its path
+  as tex expects it. iter_lines is called twice, to hash and to write,
+  so the content is never held whole in memory.
+  """
+  digest = hashlib.sha256()
+  for line in iter_lines():
+    digest.update(line.encode("utf-8"))
+    digest.update(b"\n")
+  path = os.path.join(directory, "%s.%s" % (digest.hexdigest()[:32], ext))
+  if not os.path.exists(path):
+    ## Written aside and renamed, so a file under a hash is complete
+    temp = "%s.%d.tmp" % (path, os.getpid())
+    with open(temp, "w", encoding="utf-8") as f:
+      for line in iter_lines():
+        f.write(line)
+        f.write("\n")
+    os.replace(temp, path)
+  return path.replace(os.sep, "/")
+
+class PlotFile(object):
+  """A polyline read from a side file of "x y" lines by tikz plot file."""
+  __slots__ = ("options", "file")
+
+  def __init__(self, options, file):
+    self.options = options
+    self.file = file
+
+  def dumps(self):
+    if self.options.isempty():
+      return "\\path plot file {%s};" % self.file
+    return "\\path[%s] plot file {%s};" % (self.options.dumps(), self.file)
+
 class Point(HasOptions):
+  __slots__ = ("data",)
+
   def __init__(self, data):
     if not isinstance(data, Node) and \
        not isinstance(data, NodeAnchor) and \
@@ -494,14 +879,28 @@ class Point(HasOptions):
     super(Point, self).__init__()
 
   def dumps(self):
+    options = self.options.dumps()
+    ## A node keeps its identity when Canvas.replace gives it another handle
+    if isinstance(self.data, Node):
+      handle = self.data.handle
+    elif isinstance(self.data, NodeAnchor):
+      handle = self.data.node.handle
+    else:
+      handle = None
+    cache = self._dumps
+    if cache is not None and cache[0] is options and cache[1] is self.data and \
+       cache[2] is handle:
+      return cache[3]
     if isinstance(self.data, Node) or isinstance(self.data, NodeAnchor):
-      return "(%s %s)" % (
-        ("[%s]" % self.options.dumps()) if not self.options.isempty() else "",
+      ret = "(%s %s)" % (
+        ("[%s]" % options) if options else "",
         self.data.handle if isinstance(self.data, Node) else self.data.dumps(),
       )
-
-    # Now it is coordinate
-    return self.data.dumps()
+    else:
+      # Now it is coordinate
+      ret = self.data.dumps()
+    self._dumps = (options, self.data, handle, ret)
+    return ret
 
   @classmethod
   def from_str(cls, s):
@@ -518,6 +917,8 @@ class Point(HasOptions):
     return self.unset("xshift").unset("yshift")
 
 class Line(HasOptions):
+  __slots__ = ("linetype", "path", "additional")
+
   legal_types = set(['--', '-|', '|-', 'to', 'rectangle', 'circle', 'arc', 'edge'])
   def __init__(self, linetype, path=None):
     super(Line, self).__init__()
@@ -530,15 +931,24 @@ class Line(HasOptions):
     self.additional = None
 
   def dumps(self):
+    options = self.options.dumps()
+    additional, additional_options, additional_text = self.additional, None, None
+    if isinstance(additional, Node):
+      additional_options = additional.options.dumps()
+      additional_text = additional.text
+    cache = self._dumps
+    if cache is not None and cache[0] is options and cache[1] is additional \
+       and cache[2] is additional_options and cache[3] is additional_text:
+      return cache[4]
     ret = self.linetype
-    if not self.options.isempty():
-      ret = "%s[%s]" % (ret, self.options.dumps())
-    if self.additional is None:
-      return ret
-    if isinstance(self.additional, Node):
-      return "%s node[%s]{%s}" % (
-        ret, self.additional.options.dumps(), self.additional.text)
-    raise TypeError("Unknown additional information %s" % str(self.additional))
+    if options:
+      ret = "%s[%s]" % (ret, options)
+    if isinstance(additional, Node):
+      ret = "%s node[%s]{%s}" % (ret, additional_options, additional_text)
+    elif additional is not None:
+      raise TypeError("Unknown additional information %s" % str(additional))
+    self._dumps = (options, additional, additional_options, additional_text, ret)
+    return ret
 
   def set_above_text(self, text):
     self.additional = Node(None, None).set_text(text) \
@@ -556,43 +966,57 @@ class Line(HasOptions):
   def to_angle(self, angle):
     return self.set("in", str(angle))
 
+## One item of a path expression, e.g. "(0,0) -- (1,2) -| ++(3,4)":
+## a coordinate or one of Line.legal_types. Anything else is caught
+## by the last group, so that finditer covers the whole expression.
+_path_token_regex = re.compile(
+  r'\s*(?:(?P<relative>\+\+)?\(\s*(?P<x>-?[0-9]+(?:\.[0-9]+)?)\s*'
+  r',\s*(?P<y>-?[0-9]+(?:\.[0-9]+)?)\s*\)'
+  r'|(?P<line>--|-\||\|-|(?:to|rectangle|circle|arc|edge)(?![A-Za-z]))'
+  r'|(?P<invalid>\S+))')
+
 class Path(HasOptions):
+  ## lines and points index the Line and Point items in order,
+  ## kept up to date by append
+  __slots__ = ("items", "canvas", "lines", "points")
+
   def __init__(self, canvas):
     self.items = []
+    self.lines = []
+    self.points = []
     self.canvas = canvas;
     super(Path, self).__init__()
 
+  def append(self, item):
+    self.items.append(item)
+    if isinstance(item, Line):
+      self.lines.append(item)
+    else:
+      self.points.append(item)
+      if self.canvas is not None:
+        if isinstance(item.data, Node):
+          self.canvas.add_reference(item.data.handle, self)
+        elif isinstance(item.data, NodeAnchor):
+          self.canvas.add_reference(item.data.node.handle, self)
+    return self
+
   def extend(self, item):
-    if isinstance(item, Point):
-      self.items.append(item)
-      return self
+    if isinstance(item, CoordinateArray):
+      return self.extend_array(item)
+    elif isinstance(item, Point):
+      return self.append(item)
     elif isinstance(item, Line):
       if len(self.items) > 0 and isinstance(self.items[-1], Line):
         raise TypeError("Cannot include consecutive lines")
-      self.items.append(item)
-      return self
+      return self.append(item)
     elif isinstance(item, Node) or isinstance(item, NodeAnchor) or isinstance(item, Coordinate):
-      self.items.append(Point(item))
-      return self
+      return self.append(Point(item))
     elif isinstance(item, str):
-      try:
-        coord = Coordinate.from_str(item)
-        self.items.append(Point(coord))
-        return self
-      except Exception as e:
-        pass
-
-      try:
-        line = Line(item, path=self)
+      if item in Line.legal_types:
         if len(self.items) > 0 and isinstance(self.items[-1], Line):
-          print("Cannot include consecutive lines: %s" % item)
-          raise TypeError("Cannot include consecutive lines")
-        self.items.append(line)
-        return self
-      except Exception as e:
-        pass
-
-      raise ValueError("Invalid path item: %s" % item)
+          raise TypeError("Cannot include consecutive lines: %s" % item)
+        return self.append(Line(item, path=self))
+      return self.extend_str(item)
     elif isinstance(item, list):
       for e in item:
         self.extend(e)
@@ -600,6 +1024,48 @@ class Path(HasOptions):
 
     raise TypeError("Invalid path item type: %s" % str(item))
 
+  def extend_str(self, s):
+    """
+    Append the coordinates and lines of a path expression, such as
+    "(0,0) -- (1,2) -| (3,4) to (5,6)", in a single pass over it. The
+    path is left as it was if the expression is invalid.
+    """
+    items, lines, points = [], [], []
+    last_is_line = len(self.items) > 0 and isinstance(self.items[-1], Line)
+    for m in _path_token_regex.finditer(s):
+      relative, x, y, linetype, invalid = m.group(
+        "relative", "x", "y", "line", "invalid")
+      if invalid is not None:
+        raise ValueError("Invalid path item: %s" % invalid)
+      if linetype is None:
+        item = Point(Coordinate(float(x), float(y), relative=relative is not None))
+        points.append(item)
+        last_is_line = False
+      else:
+        if last_is_line:
+          raise TypeError("Cannot include consecutive lines: %s" % s)
+        item = Line(linetype, path=self)
+        lines.append(item)
+        last_is_line = True
+      items.append(item)
+    if len(items) == 0:
+      raise ValueError("Invalid path item: %s" % s)
+    self.items.extend(items)
+    self.lines.extend(lines)
+    self.points.extend(points)
+    return self
+
+  def extend_array(self, coords):
+    """
+    Append the points of a CoordinateArray joined by --, also joined
+    to the last point of the path if there is one.
+    """
+    for x, y in coords.xy.tolist():
+      if len(self.items) > 0 and isinstance(self.items[-1], Point):
+        self.append(Line("--", path=self))
+      self.append(Point(Coordinate(x, y)))
+    return self
+
   def dumps(self):
     if len(self.items) == 0:
       raise ValueError("Empty path")
@@ -611,22 +1077,14 @@ class Path(HasOptions):
     return "\\path[%s] %s;" % (self.options.dumps(), pathstr)
 
   def get_line(self, i):
-    counter = 0
-    for j in range(len(self.items)):
-      if isinstance(self.items[j], Line):
-        if counter == i:
-          return self.items[j]
-        counter += 1
-    raise ValueError("cannot find the %d'th line" % i)
+    if i < 0 or i >= len(self.lines):
+      raise ValueError("cannot find the %d'th line" % i)
+    return self.lines[i]
 
   def get_point(self, i):
-    counter = 0
-    for j in range(len(self.items)):
-      if isinstance(self.items[j], Point):
-        if counter == i:
-          return self.items[j]
-        counter += 1
-    raise ValueError("cannot find the %d'th point" % i)
+    if i < 0 or i >= len(self.points):
+      raise ValueError("cannot find the %d'th point" % i)
+    return self.points[i]
 
   def set_line(self, i, key, value=None):
     return self.get_line(i).set(key, value)
@@ -638,10 +1096,7 @@ class Path(HasOptions):
     return self.get_point(i).set(key, value)
 
   def last_point(self):
-    for i in reversed(range(len(self.items))):
-      if isinstance(self.items[i], Point):
-        return self.items[i]
-    return None
+    return self.points[-1] if len(self.points) > 0 else None
 
   def draw_to(self, coordinate, line=None):
     if isinstance(self.items[-1], Point):
@@ -679,27 +1134,33 @@ class Onslide(object):
 
 class Builder(object):
   def __init__(self):
-    self.switches = set()
+    ## Ordered like DrawOptions.switches
+    self.switches = dict()
     self.unsets = set()
     self.properties = dict()
     self.to_set_text = None
     self.to_set_pos = None
+    ## The style shared by the items this builder applies to,
+    ## until the next set or unset
+    self.shared = None
 
   def set(self, key, value=None):
     if value is None:
-      self.switches.add(key)
+      self.switches[key] = None
     else:
       self.properties[key] = value
     self.unsets.discard(key)
+    self.shared = None
 
   def unset(self, key):
     ## Usually, a switch and a key-value property will
     ## never have the same name
     if key in self.switches:
-      self.switches.remove(key)
+      self.switches.pop(key)
     elif key in self.properties:
-      self.properties.remove(key)
+      self.properties.pop(key)
     self.unsets.add(key)
+    self.shared = None
 
   def set_text(self, text):
     self.to_set_text = text
@@ -713,13 +1174,48 @@ class Builder(object):
   def clear_set_pos(self):
     self.to_set_pos = None
 
-  def apply(self, item):
+  def apply_options(self, options):
     for switch in self.switches:
-      item.set(switch)
+      options.set(switch)
     for key in self.properties:
-      item.set(key, self.properties[key])
+      options.set(key, self.properties[key])
     for key in self.unsets:
-      item.unset(key)
+      options.unset(key)
+
+  def style(self, styles=None):
+    """
+    The options of this builder as a DrawOptions to share. Builders
+    with the same options get the same style from the same styles dict.
+    """
+    if self.shared is not None or \
+       (len(self.switches) == 0 and len(self.properties) == 0):
+      return self.shared
+    key = (tuple(self.switches), tuple(self.properties.items()))
+    try:
+      hash(key)
+    except TypeError:
+      ## Some value cannot be hashed, do not intern this style
+      styles = None
+    if styles is not None and key in styles:
+      self.shared = styles[key]
+      return self.shared
+    self.shared = DrawOptions()
+    self.apply_options(self.shared)
+    if styles is not None:
+      styles[key] = self.shared
+    return self.shared
+
+  def apply(self, item, styles=None):
+    if item.options.isempty():
+      ## Nothing to unset, and nothing the style would need to override
+      item.options = DrawOptions(self.style(styles))
+    else:
+      for switch in self.switches:
+        item.set(switch)
+      for key in self.properties:
+        item.set(key, self.properties[key])
+      for key in self.unsets:
+        item.unset(key)
     if isinstance(item, Node):
       if self.to_set_text is not None:
         item.set_text(self.to_set_text)
@@ -833,9 +1329,12 @@ class PositionSet(object):
     if isinstance(item, list):
       for e in item:
         self.add(e)
+    elif isinstance(item, CoordinateArray):
+      ## Absolute by construction
+      self.items.extend(item)
     elif isinstance(item, str):
       try:
-        coord = Coordinate.from_str(str)
+        coord = Coordinate.from_str(item)
         if coord.relative:
           raise ValueError("Coordinate should not be relative")
         self.items.append(coord)
@@ -878,7 +1377,9 @@ class PositionSet(object):
 
     position_set = PositionSet()
 
-    if coords is not None:
+    if isinstance(coords, CoordinateArray):
+      position_set.add(coords)
+    elif coords is not None:
       for coord in coords:
         x, y = coord
         position_set.add(Coordinate(x, y))
@@ -902,12 +1403,529 @@ class PositionSet(object):
 
     return position_set
 
+## Lengths in cm, the unit of plain tikz coordinates
+_LENGTH_UNITS = {"cm": 1.0, "mm": 0.1, "in": 2.54, "pt": 2.54 / 72.27,
+                 "bp": 2.54 / 72}
+_length_regex = re.compile(r"^\s*(-?[0-9]*\.?[0-9]+)\s*(cm|mm|in|pt|bp)?\s*$")
+
+def parse_length(value, unit="cm"):
+  """
+  A tikz length in cm, with unit for plain numbers, or None for lengths
+  that depend on the font or on TeX macros, such as 2em or 0.5\\linewidth.
+  """
+  if isinstance(value, numbers.Real):
+    return float(value) * _LENGTH_UNITS[unit]
+  m = _length_regex.match(str(value))
+  if m is None:
+    return None
+  return float(m.group(1)) * _LENGTH_UNITS[m.group(2) or unit]
+
+class PositionResolver(object):
+  """
+  Computes the positions the tikz positioning library would give to
+  nodes placed relative to other nodes, such as right=of node3, and
+  replaces them by plain at (x,y), so that TeX does not have to follow
+  long chains of nodes.
+
+  A node is only resolved when its size and the size of its target are
+  known from their options: a rectangle or circle with its minimum width
+  and height (or minimum size) in absolute units, and text assumed to
+  fit within that size. Other nodes, and the nodes placed relative to
+  them, keep their relative placement.
+  """
+
+  ## Direction of each positioning key as (horizontal, vertical) signs
+  directions = {
+    "above": (0, 1), "below": (0, -1), "left": (-1, 0), "right": (1, 0),
+    "above left": (-1, 1), "above right": (1, 1),
+    "below left": (-1, -1), "below right": (1, -1),
+  }
+
+  ## Anchor names back to directions, for targets such as node3.north
+  anchors = {
+    "center": (0, 0), "north": (0, 1), "south": (0, -1), "east": (1, 0),
+    "west": (-1, 0), "north east": (1, 1), "north west": (-1, 1),
+    "south east": (1, -1), "south west": (-1, -1),
+  }
+
+  ## Line widths in pt, the default outer sep being half of it
+  line_widths = {
+    "ultra thin": 0.1, "very thin": 0.2, "thin": 0.4, "semithick": 0.6,
+    "thick": 0.8, "very thick": 1.2, "ultra thick": 1.6,
+  }
+
+  ## Options that move or deform a node in ways not followed here
+  transforms = ["anchor", "xshift", "yshift", "shift", "rotate", "scale",
+                "xscale", "yscale", "transform shape", "on grid"]
+
+  shapes = ["ellipse", "diamond", "trapezium", "semicircle", "star",
+            "regular polygon", "isosceles triangle", "kite", "dart",
+            "circular sector", "cylinder", "cloud", "rounded rectangle"]
+
+  _placement_regex = re.compile(r"^(?:(\S+)(?: and (\S+))? )?of (\S+?)(?:\.(.+))?$")
+
+  def __init__(self, node_distance=None):
+    ## The initial tikz node distance, vertical and horizontal
+    node_distance = "1cm and 1cm" if node_distance is None else str(node_distance)
+    if " and " in node_distance:
+      vertical, horizontal = node_distance.split(" and ")
+      self.diagonal_factor = 1.0
+    else:
+      vertical, horizontal = node_distance, node_distance
+      ## A single distance is along the diagonal for diagonal placements
+      self.diagonal_factor = math.sqrt(0.5)
+    self.vertical = parse_length(vertical)
+    self.horizontal = parse_length(horizontal)
+
+  def transformed(self, node):
+    return any(node.options.isset(key) or node.get(key) is not None
+               for key in self.transforms)
+
+  def size(self, node):
+    """
+    (circle, half width, half height) of the node, up to its anchors,
+    or None when it cannot be told without TeX.
+    """
+    shape = node.get("shape")
+    circle = node.options.isset("circle") or shape == "circle"
+    if shape not in [None, "rectangle", "circle"] or \
+       any(node.options.isset(other) for other in self.shapes):
+      return None
+    minimum = node.get("minimum size")
+    width = node.get("minimum width")
+    height = node.get("minimum height")
+    width = minimum if width is None else width
+    height = minimum if height is None else height
+    if width is None or height is None:
+      return None
+    ## Unitless sizes are in pt in tikz, unlike coordinates
+    width, height = parse_length(width, "pt"), parse_length(height, "pt")
+    if width is None or height is None:
+      return None
+    if minimum is not None and parse_length(minimum, "pt") is not None:
+      width = max(width, parse_length(minimum, "pt"))
+      height = max(height, parse_length(minimum, "pt"))
+    outer_sep = node.get("outer sep")
+    if outer_sep is None:
+      line_width = node.get("line width")
+      if line_width is None:
+        line_width = 0.4
+        for key, value in self.line_widths.items():
+          if node.options.isset(key):
+            line_width = value
+      outer_sep = parse_length(line_width, "pt")
+      outer_sep = None if outer_sep is None else outer_sep / 2
+    else:
+      outer_sep = parse_length(outer_sep, "pt")
+    if outer_sep is None:
+      return None
+    if circle:
+      radius = max(width, height) / 2 + outer_sep
+      return True, radius, radius
+    return False, width / 2 + outer_sep, height / 2 + outer_sep
+
+  def offset(self, size, horizontal, vertical):
+    ## From the center of a node to its anchor in that direction
+    circle, half_width, half_height = size
+    if circle and horizontal != 0 and vertical != 0:
+      return (horizontal * half_width * math.sqrt(0.5),
+              vertical * half_height * math.sqrt(0.5))
+    return horizontal * half_width, vertical * half_height
+
+  def placement(self, node):
+    """(key, direction, shift, target handle, target anchor) or None."""
+    keys = [key for key in self.directions if node.get(key) is not None]
+    if len(keys) != 1 or node.at is not None or self.transformed(node):
+      return None
+    key = keys[0]
+    m = self._placement_regex.match(str(node.get(key)))
+    if m is None:
+      return None
+    first, second, target, anchor = m.groups()
+    horizontal, vertical = self.directions[key]
+    if first is None:
+      if self.horizontal is None or self.vertical is None:
+        return None
+      factor = self.diagonal_factor if horizontal != 0 and vertical != 0 else 1.0
+      dx, dy = self.horizontal * factor, self.vertical * factor
+    elif second is None:
+      dx = dy = parse_length(first)
+      if dx is None:
+        return None
+      if horizontal != 0 and vertical != 0:
+        dx = dy = dx * math.sqrt(0.5)
+    else:
+      ## "vertical and horizontal", as written by RelativePosition
+      dy, dx = parse_length(first), parse_length(second)
+      if dx is None or dy is None:
+        return None
+    if anchor is None:
+      anchor = (horizontal, vertical)
+    elif anchor in self.anchors:
+      anchor = self.anchors[anchor]
+    else:
+      return None
+    return key, (horizontal, vertical), (horizontal * dx, vertical * dy), \
+      target, anchor
+
+  def resolve(self, canvas):
+    """Resolve the nodes of canvas in place, returning how many were."""
+    centers = dict() # handle -> center of the nodes with a known position
+    sizes = dict()
+    waiting = dict() # target handle -> nodes placed relative to it
+    for item in canvas.items:
+      if not isinstance(item, Node):
+        continue
+      sizes[item.handle] = self.size(item)
+      placement = self.placement(item)
+      if placement is not None:
+        waiting.setdefault(placement[3], []).append((item, placement))
+      elif isinstance(item.at, Coordinate) and not item.at.relative and \
+           not self.transformed(item) and \
+           not any(item.get(key) is not None for key in self.directions):
+        centers[item.handle] = (item.at._x, item.at._y)
+
+    ## Nodes are resolved from the ones with a known position outwards,
+    ## without recursion since rows may be thousands of nodes long
+    resolved = 0
+    queue = list(centers)
+    while len(queue) > 0:
+      handle = queue.pop()
+      target_center, target_size = centers[handle], sizes[handle]
+      for node, placement in waiting.pop(handle, []):
+        key, (horizontal, vertical), (dx, dy), _, anchor = placement
+        size = sizes[node.handle]
+        if size is None or (target_size is None and anchor != (0, 0)):
+          continue
+        x, y = target_center
+        if anchor != (0, 0):
+          ax, ay = self.offset(target_size, *anchor)
+          x, y = x + ax, y + ay
+        ## The node's opposite anchor goes at the shifted target anchor
+        ox, oy = self.offset(size, horizontal, vertical)
+        center = (x + dx + ox, y + dy + oy)
+        node.unset(key)
+        node.set_pos(center)
+        centers[node.handle] = center
+        queue.append(node.handle)
+        resolved += 1
+    return resolved
+
+class NodeArray(object):
+  """
+  Nodes made in bulk by Canvas.make_nodes_from_arrays, stored column by
+  column instead of as one Node per row, and serialized in bulk.
+  Row i has the handle node<start + i>.
+  """
+  __slots__ = ("canvas", "start", "count", "xy", "texts", "options",
+               "columns", "file")
+
+  def __init__(self, canvas, start, xy, texts, options, columns):
+    self.canvas = canvas
+    self.start = start
+    self.count = len(xy)
+    self.xy = xy
+    self.texts = texts
+    ## DrawOptions shared by all rows
+    self.options = options
+    ## Option key -> per-row values; booleans are per-row switches
+    self.columns = columns
+    ## The side file the rows were spilled to, see spill
+    self.file = None
+
+  def __len__(self):
+    return self.count
+
+  def spill(self, directory):
+    """
+    Write the rows to a side file read by \\input, and drop them from
+    memory. The nodes cannot be changed afterwards.
+    """
+    self.file = write_data_file(directory, self.iter_dumps, "tex")
+    self.xy = self.texts = self.columns = None
+    return self
+
+  def handle(self, i):
+    return "node%d" % (self.start + i)
+
+  def node(self, i):
+    ## A stand-in for row i to refer to it, e.g. in connect or NodeAnchor.
+    ## It is not part of the canvas, options set on it are not drawn.
+    return Node(self.canvas, self.handle(i))
+
+  def format_column(self, key, values):
+    import numpy
+    values = numpy.asarray(values)
+    if values.dtype == bool:
+      return [key if value else "" for value in values.tolist()]
+    if values.dtype.kind in "iuf":
+      values = format_numbers(values.astype(float))
+    else:
+      values = [str(value) for value in values.tolist()]
+    return ["%s=%s" % (key, value) for value in values]
+
+  def iter_dumps(self, styles=None):
+    if self.file is not None:
+      yield "\\input{%s}" % self.file
+      return
+    n = len(self)
+    xs = format_numbers(self.xy[:, 0])
+    ys = format_numbers(self.xy[:, 1])
+    texts = self.texts if self.texts is not None else [""] * n
+    shared = self.options.dumps()
+    if styles is not None and styles.name(shared) is not None:
+      shared = styles.name(shared)
+    columns = [self.format_column(key, values)
+               for key, values in self.columns.items()]
+    if len(columns) == 0:
+      options = [("[%s]" % shared) if shared else ""] * n
+    else:
+      options = []
+      for row in zip(*columns):
+        row = ",".join([part for part in (shared,) + row if part])
+        options.append(("[%s]" % row) if row else "")
+    yield from map("\\node%s(node%d)at (%s,%s){%s};".__mod__,
+                   zip(options, range(self.start, self.start + n), xs, ys, texts))
+
+  def dumps(self):
+    return "\n".join(self.iter_dumps())
+
+class NodeGrid(object):
+  """
+  A rows x cols grid of nodes made by Canvas.make_grid, written as one
+  \\matrix of nodes instead of one positioned \\node per cell. The
+  matrix is itself a node with the grid's handle, and cell (i, j),
+  counted from 0, is the node <handle>-<i+1>-<j+1>.
+  """
+  __slots__ = ("canvas", "handle", "rows", "cols", "texts", "options",
+               "nodes", "cells", "at")
+
+  def __init__(self, canvas, handle, rows, cols, texts, options, nodes, at=None):
+    self.canvas = canvas
+    self.handle = handle
+    self.rows = rows
+    self.cols = cols
+    ## A list of rows of texts, or None for empty cells
+    self.texts = texts
+    ## DrawOptions of the matrix, and shared by all cells
+    self.options = options
+    self.nodes = nodes
+    ## (i, j) -> DrawOptions of single cells, allocated on first use
+    self.cells = None
+    self.at = at
+
+  def __len__(self):
+    return self.rows * self.cols
+
+  def check(self, i, j):
+    if i < 0 or i >= self.rows or j < 0 or j >= self.cols:
+      raise ValueError("no cell (%d, %d) in a %dx%d grid" %
+                       (i, j, self.rows, self.cols))
+
+  def cell_handle(self, i, j):
+    return "%s-%d-%d" % (self.handle, i + 1, j + 1)
+
+  def cell(self, i, j):
+    ## A stand-in for the cell to refer to it, e.g. in connect or
+    ## NodeAnchor; use set_cell to change how the cell is drawn
+    self.check(i, j)
+    return Node(self.canvas, self.cell_handle(i, j))
+
+  def __getitem__(self, ij):
+    return self.cell(*ij)
+
+  def row(self, i):
+    return [self.cell(i, j) for j in range(self.cols)]
+
+  def column(self, j):
+    return [self.cell(i, j) for i in range(self.rows)]
+
+  def set_cell(self, i, j, key, value=None):
+    self.check(i, j)
+    if self.cells is None:
+      self.cells = dict()
+    self.cells.setdefault((i, j), DrawOptions()).set(key, value)
+    return self
+
+  def set_text(self, i, j, text):
+    self.check(i, j)
+    if self.texts is None:
+      self.texts = [[""] * self.cols for _ in range(self.rows)]
+    self.texts[i][j] = text
+    return self
+
+  def iter_dumps(self, styles=None):
+    nodes = self.nodes.dumps()
+    if styles is not None and styles.name(nodes) is not None:
+      nodes = styles.name(nodes)
+    ## Empty cells still get a node, so that every cell handle exists.
+    ## & is replaced since frames change its catcode.
+    options = ["matrix of nodes", "nodes in empty cells",
+               "ampersand replacement=\\&"]
+    if nodes:
+      options.append("nodes={%s}" % nodes)
+    if not self.options.isempty():
+      options.append(self.options.dumps())
+    at = ""
+    if self.at is not None:
+      at = "at %s" % (self.at if isinstance(self.at, str) else
+        ("(%s)" % self.at.dumps() if isinstance(self.at, NodeAnchor)
+          else self.at.dumps()))
+    yield "\\matrix[%s](%s)%s{" % (",".join(options), self.handle, at)
+    empty = [""] * self.cols
+    for i in range(self.rows):
+      texts = self.texts[i] if self.texts is not None else empty
+      if self.cells is not None:
+        texts = [("|[%s]| %s" % (self.cells[(i, j)].dumps(), text))
+                 if (i, j) in self.cells else text
+                 for j, text in enumerate(texts)]
+      yield "%s \\\\" % " \\& ".join(texts)
+    yield "};"
+
+  def dumps(self):
+    return "\n".join(self.iter_dumps())
+
+class EdgeList(object):
+  """
+  Edges made in bulk by Canvas.connect_many, written as one \\path per
+  source, e.g. \\path[->] (node0) edge (node1) edge[red] (node2);
+  instead of one Path per edge.
+  """
+  __slots__ = ("canvas", "options", "edges")
+
+  def __init__(self, canvas, options):
+    self.canvas = canvas
+    ## DrawOptions of every edge
+    self.options = options
+    ## Source point -> list of (target point, options string or None)
+    self.edges = dict()
+
+  def __len__(self):
+    return sum(len(targets) for targets in self.edges.values())
+
+  @classmethod
+  def point(cls, point):
+    if isinstance(point, Node):
+      return "(%s)" % point.handle
+    if isinstance(point, NodeAnchor):
+      return "(%s)" % point.dumps()
+    if isinstance(point, Coordinate):
+      return point.dumps()
+    if isinstance(point, tuple):
+      return Coordinate(*point).dumps()
+    if isinstance(point, str):
+      return point if point.startswith("(") else "(%s)" % point
+    raise TypeError("Invalid edge end: %s" % str(point))
+
+  def add(self, source, target, options=None):
+    if isinstance(options, dict):
+      draw_options = DrawOptions()
+      for key, value in options.items():
+        draw_options.set(key, value)
+      options = draw_options.dumps()
+    self.edges.setdefault(self.point(source), []).append(
+      (self.point(target), options if options else None))
+    return self
+
+  def drop(self, *handles):
+    """Drop the edges from or to the nodes with these handles."""
+    handles = set(handles)
+    def touches(point):
+      return point.startswith("(") and point[1:-1].split(".")[0] in handles
+    for source in list(self.edges):
+      if touches(source):
+        del self.edges[source]
+      else:
+        self.edges[source] = [edge for edge in self.edges[source]
+                              if not touches(edge[0])]
+    return self
+
+  def iter_dumps(self, styles=None):
+    options = self.options.dumps()
+    if styles is not None and styles.name(options) is not None:
+      options = styles.name(options)
+    command = "\\path[%s]" % options if options else "\\path"
+    for source, targets in self.edges.items():
+      if len(targets) == 0:
+        continue
+      yield "%s %s %s;" % (command, source, " ".join([
+        ("edge[%s] %s" % (edge_options, target)) if edge_options is not None
+        else ("edge %s" % target) for target, edge_options in targets]))
+
+  def dumps(self):
+    return "\n".join(self.iter_dumps())
+
+class StyleTable(object):
+  """
+  Names for the option strings repeated in a canvas, to write each of
+  them once as a \\tikzset style instead of on every item using it.
+  count() the canvas first, then assign() the names. A name is derived
+  from the options it stands for, so it does not depend on the other
+  options of the canvas.
+  """
+
+  def __init__(self, prefix="pb", min_count=2):
+    self.prefix = prefix
+    self.min_count = min_count
+    self.counts = dict() # options string -> number of items using it
+    self.names = dict() # options string -> style name
+    self.used = set() # style names
+
+  def count(self, canvas):
+    for options, n in canvas.iter_options():
+      self.counts[options] = self.counts.get(options, 0) + n
+    return self
+
+  def assign(self):
+    for options, count in self.counts.items():
+      ## A # would be taken for a parameter of the style
+      if count < self.min_count or options in self.names or "#" in options:
+        continue
+      digest = hashlib.sha256(options.encode("utf-8")).hexdigest()
+      length = 8
+      ## Two options strings with the same short hash
+      while "%s%s" % (self.prefix, digest[:length]) in self.used:
+        length += 8
+      name = "%s%s" % (self.prefix, digest[:length])
+      if len(name) < len(options):
+        self.names[options] = name
+        self.used.add(name)
+    return self
+
+  def name(self, options):
+    return self.names.get(options)
+
+  def dumps(self):
+    if len(self.names) == 0:
+      return ""
+    return "\\tikzset{%s}" % ",\n".join([
+      "%s/.style={%s}" % (name, options)
+      for options, name in self.names.items()])
+
 class Canvas(object):
   def __init__(self):
+    ## Removed items leave None in items until it is compacted
     self.items = []
     self.handle_counter = 0
     self.builder = None
 
+    # Indexes for get, remove and replace
+    self.positions = dict() # id(item) -> position in items
+    self.index = dict() # handle -> Node
+    self.node_arrays = [] # NodeArray in creation order, so by start
+    self.grids = dict() # handle -> NodeGrid
+    self.references = dict() # handle -> paths going through that node
+    self.aliases = dict() # handle -> other handles of the node, see replace
+    self.removed = 0
+
+    ## Styles shared between items made with the same options,
+    ## see Builder.style
+    self.styles = dict()
+
+    # Where large data goes instead of the tikz code, see spill_data
+    self.data_dir = None
+    self.spill_threshold = None
+
     # Parameters for making nodes in batch
     self.position_set = None
     self.existing = None
@@ -920,11 +1938,175 @@ class Canvas(object):
     self.handle_counter += 1
     return ret
 
+  def add(self, item):
+    self.positions[id(item)] = len(self.items)
+    self.items.append(item)
+    if isinstance(item, Node):
+      self.index[item.handle] = item
+    elif isinstance(item, NodeArray):
+      self.node_arrays.append(item)
+    elif isinstance(item, NodeGrid):
+      self.grids[item.handle] = item
+    return item
+
+  def add_reference(self, handle, path):
+    self.references.setdefault(handle, []).append(path)
+
+  def get(self, handle):
+    """
+    The node with this handle, the NodeGrid for the handle of a grid,
+    or None when there is none.
+    """
+    node = self.index.get(handle)
+    if node is None:
+      node = self.grids.get(handle)
+    if node is not None or not handle.startswith("node"):
+      return node
+    if "-" in handle:
+      ## A grid cell, <grid handle>-<row>-<column>
+      try:
+        grid, i, j = handle.rsplit("-", 2)
+        grid, i, j = self.grids.get(grid), int(i) - 1, int(j) - 1
+        return grid.cell(i, j) if grid is not None else None
+      except ValueError:
+        return None
+    try:
+      number = int(handle[4:])
+    except ValueError:
+      return None
+    i = bisect.bisect_right([nodes.start for nodes in self.node_arrays], number)
+    if i > 0 and number < self.node_arrays[i - 1].start + len(self.node_arrays[i - 1]):
+      return self.node_arrays[i - 1].node(number - self.node_arrays[i - 1].start)
+    return None
+
+  def remove(self, item):
+    """
+    Remove an item from the canvas. Removing a node also removes the
+    paths going through it. Nodes placed relative to it are kept, and
+    need to be placed again by the caller.
+    """
+    position = self.positions.pop(id(item), None)
+    if position is None:
+      raise ValueError("Item is not on this canvas: %s" % str(item))
+    self.items[position] = None
+    self.removed += 1
+    if isinstance(item, Node):
+      handles = [item.handle] + self.aliases.pop(item.handle, [])
+      for handle in handles:
+        if self.index.get(handle) is item:
+          self.index.pop(handle)
+    elif isinstance(item, NodeArray):
+      handles = [item.handle(i) for i in range(len(item))]
+      self.node_arrays.remove(item)
+    elif isinstance(item, NodeGrid):
+      handles = [item.handle] + [item.cell_handle(i, j)
+                                 for i in range(item.rows)
+                                 for j in range(item.cols)]
+      self.grids.pop(item.handle, None)
+    else:
+      handles = []
+      if isinstance(item, (Path, EdgeList)):
+        self.drop_references(item)
+    self.remove_references(handles)
+    if self.removed > len(self.items) // 2:
+      self.compact()
+    return self
+
+  def remove_references(self, handles):
+    """Remove the paths through the nodes with these handles."""
+    for handle in handles:
+      for path in self.references.pop(handle, []):
+        if isinstance(path, EdgeList):
+          ## Only the edges of these nodes, not the whole list
+          path.drop(*handles)
+        elif id(path) in self.positions:
+          self.remove(path)
+
+  def drop_references(self, path):
+    """Forget a removed path in the references of its nodes."""
+    if isinstance(path, EdgeList):
+      handles = set(point[1:-1].split(".")[0]
+                    for source, targets in path.edges.items()
+                    for point in [source] + [target for target, _ in targets])
+    else:
+      handles = set()
+      for point in path.points:
+        if isinstance(point.data, Node):
+          handles.add(point.data.handle)
+        elif isinstance(point.data, NodeAnchor):
+          handles.add(point.data.node.handle)
+    for handle in handles:
+      ## References of a replaced node are kept under its new handle
+      node = self.index.get(handle)
+      if node is not None:
+        handle = node.handle
+      paths = self.references.get(handle)
+      if paths is None:
+        continue
+      paths = [other for other in paths if other is not path]
+      if len(paths) > 0:
+        self.references[handle] = paths
+      else:
+        self.references.pop(handle)
+
+  def replace(self, item, new):
+    """
+    Put new where item is in the output. A new node takes over the
+    handle of the node it replaces, so paths through it stay valid.
+    If new was on the canvas already, its own handle becomes an alias
+    (the tikz alias option), so what refers to new by name, such as
+    edges or nodes placed relative to it, stays valid too. Replacing
+    a node by another item removes the paths through the node.
+    """
+    position = self.positions.pop(id(item), None)
+    if position is None:
+      raise ValueError("Item is not on this canvas: %s" % str(item))
+    placed = id(new) in self.positions
+    if placed:
+      ## e.g. made by make_node, drop it from where it was added
+      self.items[self.positions.pop(id(new))] = None
+      self.removed += 1
+    if isinstance(item, Node) and isinstance(new, Node):
+      aliases = self.aliases.pop(item.handle, [])
+      for alias in aliases:
+        new.set("alias=%s" % alias)
+      if placed and new.handle != item.handle:
+        new.set("alias=%s" % new.handle)
+        aliases += [new.handle] + self.aliases.pop(new.handle, [])
+        ## Paths already through new now go through the reused handle
+        paths = self.references.pop(new.handle, [])
+        if len(paths) > 0:
+          self.references.setdefault(item.handle, []).extend(paths)
+      new.handle = item.handle
+      if len(aliases) > 0:
+        self.aliases[new.handle] = aliases
+      for alias in aliases:
+        self.index[alias] = new
+    elif isinstance(item, Node):
+      handles = [item.handle] + self.aliases.pop(item.handle, [])
+      for handle in handles:
+        if self.index.get(handle) is item:
+          self.index.pop(handle)
+      self.remove_references(handles)
+    self.items[position] = new
+    self.positions[id(new)] = position
+    if isinstance(new, Node):
+      self.index[new.handle] = new
+    if self.removed > len(self.items) // 2:
+      self.compact()
+    return new
+
+  def compact(self):
+    self.items = [item for item in self.items if item is not None]
+    self.positions = {id(item): i for i, item in enumerate(self.items)}
+    self.removed = 0
+
   def onslide(self, start, end=None):
-    self.items.append(Onslide(start, end))
+    self.add(Onslide(start, end))
     return self
 
   def apply_relative_position(self, node):
+    ## node is a Node, or the DrawOptions of a grid's matrix
     target = self.relative_position[1]
     if isinstance(target, Node):
       target = target.handle
@@ -937,22 +2119,22 @@ class Canvas(object):
   def make_node(self):
     node = Node(self, self.next_handle())
     if self.builder is not None:
-      self.builder.apply(node)
+      self.builder.apply(node, self.styles)
       self.builder = None
 
     if self.relative_position is not None:
       self.apply_relative_position(node)
 
-    self.items.append(node)
+    self.add(node)
     return node
 
   def make_path(self):
     path = Path(self)
     if self.builder is not None:
-      self.builder.apply(path)
+      self.builder.apply(path, self.styles)
       self.builder = None
 
-    self.items.append(path)
+    self.add(path)
     return path
 
   def batch_set(self, nodes, key, values):
@@ -1012,7 +2194,8 @@ class Canvas(object):
     return self
 
   def with_scale(self, scale):
-    return self.with_property("scale", str(scale))
+    return self.with_property("scale", format_number(scale)
+                              if isinstance(scale, numbers.Real) else str(scale))
 
   def with_anchor(self, anchor):
     return self.with_property("anchor", anchor)
@@ -1029,7 +2212,7 @@ class Canvas(object):
 
   def apply_to(self, items):
     for item in items:
-      self.builder.apply(item)
+      self.builder.apply(item, self.styles)
     self.builder = None
     return self
 
@@ -1114,9 +2297,9 @@ class Canvas(object):
     for i in range(n):
       node = Node(self, self.next_handle())
       if self.builder is not None:
-        self.builder.apply(node)
+        self.builder.apply(node, self.styles)
       nodes.append(node)
-      self.items.append(node)
+      self.add(node)
 
     if self.position_set is not None:
       self.apply_position_set_to_nodes(nodes)
@@ -1126,8 +2309,312 @@ class Canvas(object):
     self.builder = None
     return nodes
 
+  def make_nodes_from_arrays(self, xy, texts=None, **option_columns):
+    """
+    Make len(xy) nodes at once from an Nx2 array of positions, kept
+    column-wise in a NodeArray. texts gives the text of each node.
+    Each keyword is an option, with underscores read as spaces: a
+    scalar applies to every node (True for a switch, False to clear an
+    option from the builder), an array or list gives one value per node
+    (booleans turn a switch on or off, also one set by the builder).
+    Options from the builder, e.g. with_box, apply to every node; the
+    nodes are placed by xy only, so at_pos and relative_to raise.
+    Needs NumPy.
+    """
+    import numpy
+    xy = numpy.asarray(xy, dtype=float)
+    if xy.ndim != 2 or xy.shape[1] != 2:
+      raise ValueError("xy should be an Nx2 array, got shape %s" % str(xy.shape))
+    if (self.builder is not None and self.builder.to_set_pos is not None) or \
+       self.relative_position is not None:
+      raise ValueError("Nodes made from arrays are placed by xy")
+    n = len(xy)
+    options = DrawOptions()
+    if self.builder is not None:
+      self.builder.apply_options(options)
+      if texts is None and self.builder.to_set_text is not None:
+        texts = [self.builder.to_set_text] * n
+      self.builder = None
+    if texts is not None:
+      texts = [str(text) for text in texts]
+      if len(texts) != n:
+        raise ValueError("%d texts for %d nodes" % (len(texts), n))
+    columns = {}
+    for key, value in option_columns.items():
+      key = key.replace("_", " ")
+      if isinstance(value, (list, tuple, numpy.ndarray)):
+        if len(value) != n:
+          raise ValueError("%d values of %s for %d nodes" % (len(value), key, n))
+        ## The column decides, not the builder
+        options.unset(key)
+        columns[key] = value
+      elif value is True:
+        options.set(key)
+      elif value is False:
+        options.unset(key)
+      elif value is not None:
+        options.set(key, value)
+    nodes = NodeArray(self, self.handle_counter, xy, texts, options, columns)
+    self.handle_counter += n
+    if self.spills(n):
+      nodes.spill(self.data_dir)
+    self.add(nodes)
+    return nodes
+
+  def make_grid(self, rows, cols, texts=None, column_sep=None, row_sep=None):
+    """
+    Make a rows x cols grid of nodes, written as a single tikz matrix.
+    texts is a list of rows of cell texts. Options from the builder,
+    e.g. with_box, apply to every cell, and at_pos or relative_to place
+    the grid as a whole. Needs the tikz matrix library.
+    """
+    if texts is not None:
+      texts = [[str(text) for text in row] for row in texts]
+      if len(texts) != rows or any(len(row) != cols for row in texts):
+        raise ValueError("texts should be %d rows of %d cells" % (rows, cols))
+    nodes = DrawOptions()
+    at = None
+    if self.builder is not None:
+      self.builder.apply_options(nodes)
+      if texts is None and self.builder.to_set_text is not None:
+        texts = [[self.builder.to_set_text] * cols for _ in range(rows)]
+      if self.builder.to_set_pos is not None:
+        at = self.builder.to_set_pos
+        if isinstance(at, tuple):
+          at = Coordinate(*at)
+      self.builder = None
+    options = DrawOptions()
+    if column_sep is not None:
+      options.set("column sep", column_sep)
+    if row_sep is not None:
+      options.set("row sep", row_sep)
+    if self.relative_position is not None:
+      self.apply_relative_position(options)
+    grid = NodeGrid(self, self.next_handle(), rows, cols, texts, options, nodes, at)
+    self.add(grid)
+    return grid
+
+  def plot(self, xs, ys, width, height, origin=(0, 0), xlim=None, ylim=None,
+           tolerance=0.01, method="minmax"):
+    """
+    Draw a data series sorted by x as a polyline in the width x height
+    box (in cm) at origin, scaled from xlim and ylim (the data range by
+    default). The series is first downsampled to what is visible at the
+    tolerance, in cm, as a path goes:
+    - "minmax" keeps the lowest and highest point of every tolerance
+      wide slice, so the drawn line is off by less than tolerance in x
+      and keeps every peak.
+    - "lttb" keeps width / tolerance points by Largest-Triangle-Three-
+      Buckets, which preserves the visual shape with fewer points.
+    - None keeps every point.
+    Only the part of the series within xlim is drawn, cut at its
+    bounds. Non-finite samples are skipped. Options from the builder apply to
+    the path, which is always drawn. Past the threshold of spill_data,
+    the points go to a side file and a PlotFile is returned instead of
+    a Path. Needs NumPy.
+    """
+    import numpy
+    if method not in ["minmax", "lttb", None]:
+      raise ValueError("Unknown downsampling method %s" % method)
+    if method is not None and tolerance <= 0:
+      raise ValueError("tolerance should be positive, got %s" % tolerance)
+    xs = numpy.asarray(xs, dtype=float)
+    ys = numpy.asarray(ys, dtype=float)
+    if xs.shape != ys.shape or xs.ndim != 1:
+      raise ValueError("xs and ys should be 1-d arrays of the same length")
+    finite = numpy.isfinite(xs) & numpy.isfinite(ys)
+    xs, ys = xs[finite], ys[finite]
+    if len(xs) < 2:
+      raise ValueError("Cannot plot fewer than 2 points")
+    if numpy.any(numpy.diff(xs) < 0):
+      raise ValueError("xs should be sorted")
+    if xlim is not None:
+      xs, ys = self.clip_series(xs, ys, xlim)
+    xlim = (xs[0], xs[-1]) if xlim is None else xlim
+    ylim = (ys.min(), ys.max()) if ylim is None else ylim
+
+    def scale(values, lim, size):
+      span = lim[1] - lim[0]
+      if span == 0:
+        return numpy.full(len(values), size / 2)
+      return (values - lim[0]) * (size / span)
+    x = scale(xs, xlim, width) + origin[0]
+    y = scale(ys, ylim, height) + origin[1]
+
+    if method is not None:
+      ## Over the drawn part only, which may be narrower than width
+      buckets = max(1, int(math.ceil((x[-1] - x[0]) / tolerance)))
+      if method == "minmax":
+        keep = downsample_minmax(x, y, buckets)
+      else:
+        keep = downsample_lttb(x, y, buckets + 1)
+      x, y = x[keep], y[keep]
+    if self.spills(len(x)):
+      options = DrawOptions()
+      if self.builder is not None:
+        self.builder.apply_options(options)
+        self.builder = None
+      if not options.isset("draw"):
+        options.set("draw")
+      xs, ys = format_numbers(x), format_numbers(y)
+      file = write_data_file(
+        self.data_dir, lambda: map("%s %s".__mod__, zip(xs, ys)), "table")
+      return self.add(PlotFile(options, file))
+    path = self.make_path()
+    if not path.options.isset("draw"):
+      path.set("draw")
+    return path.extend(CoordinateArray(numpy.stack([x, y], axis=1)))
+
+  @staticmethod
+  def clip_series(xs, ys, xlim):
+    """
+    The points of a series sorted by x within xlim, with the points
+    where it crosses the bounds interpolated.
+    """
+    import numpy
+    lo, hi = xlim
+    inside = (xs >= lo) & (xs <= hi)
+    if inside.all():
+      return xs, ys
+    cut_x, cut_y = [xs[inside]], [ys[inside]]
+    if xs[0] < lo < xs[-1] and lo not in cut_x[0][:1]:
+      cut_x.insert(0, [lo])
+      cut_y.insert(0, [numpy.interp(lo, xs, ys)])
+    if xs[0] < hi < xs[-1] and hi not in cut_x[-1][-1:]:
+      cut_x.append([hi])
+      cut_y.append([numpy.interp(hi, xs, ys)])
+    xs, ys = numpy.concatenate(cut_x), numpy.concatenate(cut_y)
+    if len(xs) < 2:
+      raise ValueError("Fewer than 2 points of the series within xlim")
+    return xs, ys
+
+  def spill_data(self, data_dir, threshold=1000):
+    """
+    From now on, write plots and make_nodes_from_arrays with at least
+    threshold points to side files in data_dir, named by the hash of
+    their content, that tex reads when compiling. The tikz code and
+    the canvas only keep the file name.
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    self.data_dir = os.path.abspath(data_dir)
+    self.spill_threshold = threshold
+    return self
+
+  def spills(self, n):
+    return self.data_dir is not None and n >= self.spill_threshold
+
+  def resolve_positions(self, node_distance=None):
+    """
+    Replace relative placements such as right=of node3 by the absolute
+    positions they stand for, where PositionResolver can compute them.
+    node_distance should be the one of the picture the canvas is in;
+    with a font relative one, such as 2em, nodes placed at that distance
+    stay relative.
+    """
+    return PositionResolver(node_distance).resolve(self)
+
   def connect(self, p1, p2):
     return self.with_property('draw').make_path().extend([p1, 'to', p2]).get_line(0)
 
-  def dumps(self):
-    return "\n".join([item.dumps() for item in self.items])
+  def connect_many(self, edges, style=None):
+    """
+    Connect many pairs of points at once, in an EdgeList. edges is
+    either a list of (source, target) or (source, target, options), or
+    an adjacency dict mapping each source to a list of targets or to a
+    dict from target to options. Points are nodes, anchors, coordinates
+    or handles. options, given as a tikz string or a dict, override the
+    style of a single edge. style and the options from the builder,
+    e.g. with_arrow, apply to every edge.
+    """
+    options = DrawOptions()
+    if self.builder is not None:
+      self.builder.apply_options(options)
+      self.builder = None
+    if style is not None:
+      options.set(style)
+    edge_list = EdgeList(self, options)
+    if isinstance(edges, dict):
+      for source, targets in edges.items():
+        if isinstance(targets, dict):
+          for target, edge_options in targets.items():
+            edge_list.add(source, target, edge_options)
+        else:
+          for target in targets:
+            edge_list.add(source, target)
+    else:
+      for edge in edges:
+        edge_list.add(*edge)
+    ## So that removing a node, grid or node array also drops its edges
+    handles = set()
+    for source, targets in edge_list.edges.items():
+      for point in [source] + [target for target, _ in targets]:
+        handle = point[1:-1].split(".")[0]
+        if handle not in handles and self.get(handle) is not None:
+          handles.add(handle)
+          self.add_reference(handle, edge_list)
+    self.add(edge_list)
+    return edge_list
+
+  def iter_options(self):
+    """The non-empty options strings of the items, with how many use each."""
+    for item in self.items:
+      if isinstance(item, NodeArray):
+        options = item.options.dumps()
+        ## Spilled rows are already written with their options
+        if options and item.file is None:
+          yield options, len(item)
+      elif isinstance(item, NodeGrid):
+        options = item.nodes.dumps()
+        if options:
+          yield options, len(item)
+      elif isinstance(item, (Node, Path)):
+        options = item.options.dumps()
+        if options:
+          yield options, 1
+
+  def dumps_styled(self, item, styles):
+    ret = item.dumps()
+    options = item.options.dumps()
+    name = styles.name(options) if options else None
+    if name is None:
+      return ret
+    ## ret starts with \node[options] or \path[options]
+    command = "\\node" if isinstance(item, Node) else "\\path"
+    return "%s[%s]%s" % (command, name, ret[len(command) + len(options) + 2:])
+
+  def iter_dumps(self, styles=None):
+    """
+    The tikz code item by item. With styles, a StyleTable of this
+    canvas, the styles are defined first and the items refer to them.
+    """
+    if styles is not None and len(styles.names) > 0:
+      yield styles.dumps()
+    for item in self.items:
+      if item is None:
+        continue
+      if isinstance(item, (NodeArray, NodeGrid, EdgeList)):
+        yield from item.iter_dumps(styles)
+      elif styles is not None and isinstance(item, (Node, Path)):
+        yield self.dumps_styled(item, styles)
+      else:
+        yield item.dumps()
+
+  def factor_styles(self):
+    """A StyleTable for the options repeated within this canvas."""
+    return StyleTable().count(self).assign()
+
+  def write(self, fp, styles=None):
+    ## Write item by item, without joining everything into one string
+    for i, line in enumerate(self.iter_dumps(styles)):
+      if i > 0:
+        fp.write("\n")
+      fp.write(line)
+
+  def dumps(self, factor_styles=False):
+    """
+    With factor_styles, options repeated on several items are written
+    once as \\tikzset styles at the top, and the items refer to those.
+    """
+    if not factor_styles:
+      return "\n".join(self.iter_dumps())
+    return "\n".join(self.iter_dumps(self.factor_styles()))
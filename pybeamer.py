@@ -1,16 +1,50 @@
+import os
+import shutil
+import tempfile
 from contextlib import contextmanager
 from pylatex import *
 from pylatex.utils import *
-from pylatex.base_classes import Environment, Arguments, Options
+from pylatex.base_classes import Environment, Arguments, Options, LatexObject
 from pylatex.base_classes.containers import Fragment as _Fragment
+from pylatex.base_classes.containers import Container
 from .canvas import *
+from .build import FrameCache, PictureExternalizer, WorkerPool, content_hash
+## Not used here, but exported with the package so that callers can catch it
+from .build import LaTeXError  # noqa: F401
+from .build import RERUN_EXTENSIONS, compile_until_stable, has_overlays, input_env
+
+## Placeholder dumped in place of a container's content to find the
+## tex that goes before and after it
+_CONTENT_MARKER = "%%pybeamer-content%%"
+
+
+class CanvasContent(LatexObject):
+  """The tikz code of a canvas, only serialized with the document."""
+
+  ## Set while generating to the styles factored out of the canvas
+  styles = None
+
+  def __init__(self, canvas):
+    self.canvas = canvas
+    super(CanvasContent, self).__init__()
+
+  def dumps(self):
+    if self.styles is None:
+      return self.canvas.dumps()
+    return "\n".join(self.canvas.iter_dumps(self.styles))
 
 
 @contextmanager
-def create_canvas(pic):
+def create_canvas(pic, resolve_positions=False):
+  """
+  With resolve_positions, nodes placed relative to others get absolute
+  positions computed in Python where possible, see PositionResolver.
+  """
   canvas = Canvas()
   yield canvas
-  pic.append(NoEscape(canvas.dumps()))
+  if resolve_positions:
+    canvas.resolve_positions(getattr(pic, "node_distance", None))
+  pic.append(CanvasContent(canvas))
 
 
 class CommonEnvironmentWithUtility(Environment):
@@ -47,10 +81,7 @@ class CommonEnvironmentWithUtility(Environment):
 
   @contextmanager
   def tikz(self, *, node_distance=None):
-    options = {}
-    if node_distance is not None:
-      options["node distance"] = node_distance
-    with self.create(TikZ(options=Options(**options))) as tikz:
+    with self.create(TikZPicture(node_distance=node_distance)) as tikz:
       yield tikz
 
   @contextmanager
@@ -87,6 +118,24 @@ class CommonEnvironmentWithUtility(Environment):
       yield array
 
 
+class TikZPicture(TikZ):
+  ## Set while generating to replace the picture by a precompiled graphic
+  externalizer = None
+
+  def __init__(self, *, node_distance=None, **kwargs):
+    options = {}
+    if node_distance is not None:
+      options["node distance"] = node_distance
+    super(TikZPicture, self).__init__(options=Options(**options), **kwargs)
+    self.node_distance = node_distance
+
+  def dumps(self):
+    tex = super(TikZPicture, self).dumps()
+    if self.externalizer is None:
+      return tex
+    return self.externalizer.include(tex)
+
+
 class BeamerEnumerate(Enumerate, CommonEnvironmentWithUtility):
   _latex_name = "enumerate"
   pass
@@ -153,6 +202,188 @@ class Fragment(_Fragment, CommonEnvironmentWithUtility):
       yield frame
 
 
+def _container_parts(container):
+  ## Collect the packages of the real content before it is swapped out
+  container._propagate_packages()
+  data = container.data
+  container.data = [NoEscape(_CONTENT_MARKER)]
+  try:
+    head, tail = container.dumps().split(_CONTENT_MARKER)
+  finally:
+    container.data = data
+  return head, tail
+
+
+def write_latex(fp, item, escape=True):
+  """
+  Write item to fp as dumps_list([item]) would, but container by
+  container, and canvases line by line, without building the whole
+  string in memory.
+  """
+  if isinstance(item, CanvasContent):
+    item.canvas.write(fp, item.styles)
+  elif isinstance(item, Container) and \
+      not item.separate_paragraph and not item.begin_paragraph and \
+      not item.end_paragraph and \
+      not getattr(item, "omit_if_empty", False) and \
+      getattr(item, "externalizer", None) is None:
+    head, tail = _container_parts(item)
+    fp.write(head)
+    for i, child in enumerate(item.data):
+      if i > 0:
+        fp.write(item.content_separator)
+      write_latex(fp, child, item.escape)
+    fp.write(tail)
+  else:
+    fp.write(dumps_list([item], escape=escape))
+
+
+def _find_items(container, cls):
+  for item in container.data:
+    if isinstance(item, cls):
+      yield item
+    if isinstance(item, Container):
+      yield from _find_items(item, cls)
+
+
+def _contains_frame(container):
+  for item in container.data:
+    if isinstance(item, Frame):
+      return True
+    if isinstance(item, Container) and _contains_frame(item):
+      return True
+  return False
+
+
+class FrameSource(object):
+  """
+  The tex of a single frame, together with everything it needs to be
+  compiled on its own: the environments around it, the content outside
+  frames before it, such as \\newcommand or \\setbeamercolor, the section
+  headings right before it and the counters at the point it starts.
+  """
+
+  def __init__(self, opening, carried, leading, body, closing,
+               framenumber, section, subsection, has_heading):
+    self.opening = opening
+    ## Content outside frames from before the previous frame
+    self.carried = carried
+    self.leading = leading
+    self.body = body
+    self.trailing = ""
+    self.closing = closing
+    self.framenumber = framenumber
+    self.section = section
+    self.subsection = subsection
+    self.has_heading = has_heading
+    self.total_frames = None
+
+  def dumps(self, preamble):
+    counters = "\\setcounter{framenumber}{%d}%%\n" \
+               "\\setcounter{section}{%d}%%\n" \
+               "\\setcounter{subsection}{%d}%%\n" % (
+                   self.framenumber, self.section, self.subsection)
+    if self.total_frames is not None:
+      counters += "\\def\\inserttotalframenumber{%d}%%\n" % self.total_frames
+    return "".join([preamble, self.opening, counters, self.carried,
+                    self.leading, self.body, "%\n", self.trailing,
+                    self.closing])
+
+
+class _FrameSplitter(object):
+  def __init__(self, outline_each_section, outline_each_subsection,
+               externalizer=None):
+    self.outline_each_section = outline_each_section
+    self.outline_each_subsection = outline_each_subsection
+    ## Told the carried content of each frame, for its pictures
+    self.externalizer = externalizer
+    self.framenumber = 0
+    self.section = 0
+    self.subsection = 0
+    self.counters = (0, 0, 0)
+    self.pending = []
+    ## Content outside frames and headings, which every later frame
+    ## needs too: the part already in earlier frames, and the pending one
+    self.carried = ""
+    self.pending_carried = []
+    self.has_heading = False
+    self.sources = []
+    ## The whole document with every frame emptied, used to
+    ## compute the table of contents
+    self.skeleton = []
+
+  def open_section(self, section):
+    if isinstance(section, Subsection):
+      if isinstance(section, Subsubsection):
+        return
+      self.subsection += 1
+      outline = self.outline_each_subsection
+    elif type(section) is Section:
+      self.section += 1
+      self.subsection = 0
+      outline = self.outline_each_section
+    else:
+      return
+    if outline and section.numbering:
+      ## \AtBeginSection inserts an outline frame
+      self.framenumber += 1
+    self.has_heading = True
+
+  def add(self, tex, carry=False):
+    self.pending.append(tex)
+    self.skeleton.append(tex)
+    if carry:
+      self.pending_carried.append(tex)
+
+  def add_frame(self, frame, opening, closing):
+    framenumber, section, subsection = self.counters
+    self.framenumber += 1
+    if self.externalizer is not None:
+      self.externalizer.carried = self.carried + "".join(self.pending_carried)
+    self.sources.append(FrameSource(
+        "".join(opening), self.carried, "".join(self.pending), frame.dumps(),
+        "".join(closing), framenumber, section, subsection, self.has_heading))
+    self.skeleton.append("\\begin{frame}\\end{frame}%\n")
+    if len(self.pending_carried) > 0:
+      self.carried += "".join(self.pending_carried)
+      self.pending_carried = []
+    self.pending = []
+    self.has_heading = False
+    self.counters = (self.framenumber, self.section, self.subsection)
+
+  def split(self, container, opening, closing):
+    for item in container.data:
+      if isinstance(item, Frame):
+        self.add_frame(item, opening, closing)
+      elif isinstance(item, Section):
+        ## A heading goes once before the next frame, even with no
+        ## frames of its own
+        head, tail = _container_parts(item)
+        self.open_section(item)
+        self.add(head)
+        self.split(item, opening, closing)
+        self.add(tail)
+      elif isinstance(item, Container) and _contains_frame(item):
+        head, tail = _container_parts(item)
+        if isinstance(item, Environment):
+          ## Environments are reopened around every frame inside them
+          self.skeleton.append(head)
+          self.split(item, opening + [head], [tail] + closing)
+          self.skeleton.append(tail)
+        else:
+          self.add(head)
+          self.split(item, opening, closing)
+          self.add(tail)
+      else:
+        self.add(dumps_list([item], escape=container.escape) + "%\n", carry=True)
+
+  def finish(self):
+    if len(self.sources) > 0:
+      self.sources[-1].trailing = "".join(self.pending)
+    for source in self.sources:
+      source.total_frames = self.framenumber
+
+
 class CJK(Environment):
   _latex_name = "CJK*"
 
@@ -167,6 +398,10 @@ class CJK(Environment):
 class Beamer(object):
   """docstring for Beamer"""
 
+  ## Set by the watch mode to a list collecting (beamer, filepath,
+  ## options) of generate_pdf calls instead of compiling them
+  captured = None
+
   def __init__(self,
                title,
                subtitle=None,
@@ -184,13 +419,19 @@ class Beamer(object):
                font_theme=None,
                main_font=None,
                math_theme=None,
-               disable_pauses=False):
+               disable_pauses=False,
+               factor_styles=False):
 
     options = []
     if disable_pauses:
       options.append("handout")
-    self.doc = Document(documentclass="beamer",
-                        document_options=options, default_filepath=default_filepath)
+    self.document = Document(documentclass="beamer",
+                             document_options=options, default_filepath=default_filepath)
+    self.doc = self.document
+    self.outline_each_section = outline_each_section
+    self.outline_each_subsection = outline_each_subsection
+    # Write options repeated in a canvas as styles, see styled
+    self.factor_styles = factor_styles
     if page_number:
       self.doc.preamble.append(
           NoEscape(r"\setbeamertemplate{footline}[frame number]"))
@@ -249,6 +490,7 @@ class Beamer(object):
         Command("usetikzlibrary", arguments=["decorations.pathreplacing"]))
     self.doc.preamble.append(
         Command("usetikzlibrary", arguments=["decorations.text"]))
+    self.doc.preamble.append(Command("usetikzlibrary", arguments=["matrix"]))
     self.doc.preamble.append(NoEscape("""
 \\newcommand{\\blue}[1]{\\textcolor{blue}{#1}}
 \\newcommand{\\green}[1]{\\textcolor{green}{#1}}
@@ -296,20 +538,81 @@ class Beamer(object):
       with self.doc.create(CJK(self.doc)) as cjk:
         self.doc = cjk
 
+    # File the tex is streamed to, see stream_tex
+    self.stream = None
+
+  @contextmanager
+  def stream_tex(self, filepath="default_path"):
+    """
+    Write the tex while the deck is being built, instead of keeping the
+    whole document in memory. The preamble is written right away, and
+    every frame is written and dropped as soon as its frame() block
+    exits. The preamble cannot change once streaming started, and the
+    document is empty afterwards.
+    """
+    chain = [self.document]
+    if self.doc is not self.document:
+      chain.append(self.doc)
+    tails = []
+    with open(filepath + ".tex", "w", encoding="utf-8") as f:
+      self.stream = f
+      try:
+        for i, container in enumerate(chain):
+          head, tail = _container_parts(container)
+          f.write(head)
+          tails.append(tail)
+          inner = chain[i + 1] if i + 1 < len(chain) else None
+          self.write_stream([item for item in container.data if item is not inner])
+          container.data[:] = [] if inner is None else [inner]
+        yield f
+        self.flush_stream()
+        for tail in reversed(tails):
+          f.write(tail)
+      finally:
+        self.stream = None
+
+  def write_stream(self, items):
+    for item in items:
+      write_latex(self.stream, item, self.doc.escape)
+      self.stream.write("%\n")
+
+  def flush_stream(self):
+    ## Write out whatever the innermost open container holds so far
+    self.write_stream(self.doc.data)
+    del self.doc.data[:]
+
+  @contextmanager
+  def streamed_heading(self, heading):
+    if self.stream is None:
+      with self.doc.create(heading) as heading:
+        yield heading
+      return
+    self.flush_stream()
+    head, tail = _container_parts(heading)
+    self.stream.write(head)
+    with self.doc.create(heading) as heading:
+      yield heading
+      self.flush_stream()
+    ## The heading is already written, do not write it again
+    self.doc.data.pop()
+    self.stream.write(tail)
+
   @contextmanager
   def section(self, title, label=True):
-    with self.doc.create(Section(title, label=label)) as section:
+    with self.streamed_heading(Section(title, label=label)) as section:
       yield section
 
   @contextmanager
   def subsection(self, title, label=True):
-    with self.doc.create(Subsection(title, label=label)) as subsection:
+    with self.streamed_heading(Subsection(title, label=label)) as subsection:
       yield subsection
 
   @contextmanager
   def frame(self, title=None):
     with self.doc.create(Frame(title=title)) as frame:
       yield frame
+    if self.stream is not None:
+      self.flush_stream()
 
   def titleframe(self):
     with self.frame() as frame:
@@ -325,11 +628,313 @@ class Beamer(object):
       frame.append(Command("center"))
       frame.append("Q&A")
 
-  def generate_tex(self, filepath="default_path"):
-    self.doc.generate_tex(filepath)
+  def frame_sources(self, externalizer=None):
+    """
+    Split the document at frame boundaries.
+    Returns the preamble, the FrameSource of every frame, and a
+    skeleton document with empty frames that has the same outline.
+    externalizer, the one pictures are externalized with, is given the
+    content carried into each frame before its pictures are.
+    """
+    head, tail = _container_parts(self.document)
+    begin = head.index("\\begin{document}")
+    splitter = _FrameSplitter(self.outline_each_section,
+                              self.outline_each_subsection, externalizer)
+    splitter.split(self.document, [head[begin:]], [tail])
+    splitter.finish()
+    skeleton = head + "".join(splitter.skeleton) + tail
+    return head[:begin], splitter.sources, skeleton
+
+  def picture_preamble(self):
+    """The preamble for compiling a single picture with the deck's look."""
+    preamble = _container_parts(self.document)[0]
+    preamble = preamble[:preamble.index("\\begin{document}")]
+    documentclass = self.document.documentclass.dumps()
+    return "\\documentclass[beamer]{standalone}" + preamble[len(documentclass):]
 
-  def generate_pdf(self, filepath="default_path", compiler=None, clean_tex=True):
-    self.doc.generate_pdf(filepath, compiler=compiler, clean_tex=clean_tex)
+  @contextmanager
+  def externalized(self, externalizer):
+    pictures = list(_find_items(self.document, TikZPicture))
+    for picture in pictures:
+      picture.externalizer = externalizer
+    try:
+      yield externalizer
+    finally:
+      for picture in pictures:
+        picture.externalizer = None
+
+  @contextmanager
+  def styled(self):
+    """
+    With factor_styles, have every canvas of the deck define the options
+    repeated in it with \\tikzset at its top and refer to them, while the
+    deck is generated. The styles stay inside each picture, so that the
+    preamble, and the key of every other frame or picture, do not change
+    with them. Canvases in frames already written by stream_tex are not
+    factored.
+    """
+    contents = list(_find_items(self.document, CanvasContent)) \
+        if self.factor_styles else []
+    for content in contents:
+      content.styles = content.canvas.factor_styles()
+    try:
+      yield
+    finally:
+      for content in contents:
+        content.styles = None
+
+  def source_uses_toc(self, source):
+    if "\\tableofcontents" in source.body:
+      return True
+    return source.has_heading and \
+        (self.outline_each_section or self.outline_each_subsection)
+
+  @contextmanager
+  def variant(self, handout):
+    """
+    Generate the deck as a handout, or with its overlays, whatever
+    disable_pauses was. None keeps it as it is.
+    """
+    documentclass = self.document.documentclass
+    if handout is None:
+      yield documentclass
+      return
+    options = [option for option in documentclass.options._positional_args
+               if option != "handout"]
+    if handout:
+      options.append("handout")
+    self.document.documentclass = Command(
+        "documentclass", arguments=documentclass.arguments, options=options)
+    try:
+      yield self.document.documentclass
+    finally:
+      self.document.documentclass = documentclass
+
+  def generate_tex(self, filepath="default_path"):
+    with open(filepath + ".tex", "w", encoding="utf-8") as f, self.styled():
+      write_latex(f, self.document)
+
+  def generate_pdf(self, filepath="default_path", compiler=None, clean_tex=True,
+                   cache_dir=None, precompile_preamble=False, externalize=False,
+                   jobs=None, workers=None, timeout=None, handout=None):
+    """
+    Without any of the options below, the deck is compiled as a whole
+    in the directory of filepath, pass after pass until its .aux, .nav,
+    .out, .snm and .toc stop changing. These files are kept next to
+    the pdf, so the next build starts from them and, unless headings
+    or the number of frames changed, takes a single pass.
+
+    With cache_dir, every frame is compiled on its own into cache_dir,
+    keyed by the hash of its tex and the preamble, and the frames are
+    merged into the final pdf. Only frames whose tex changed since an
+    earlier build are compiled again. Labels and references across
+    frames are not resolved in this mode. Content outside frames, such
+    as \\newcommand or \\setbeamercolor, is repeated in every later frame,
+    so anything it typesets outside a frame is too. Relative inputs,
+    such as images, are found in the directory of filepath and in the
+    current directory, wherever the frames are compiled.
+
+    With jobs, frames are compiled in pieces the same way, up to jobs
+    compilers at a time, in a temporary directory if no cache_dir is
+    given.
+
+    With precompile_preamble, the preamble is also dumped once into a
+    format file (needs the mylatexformat package), and every frame is
+    compiled against it instead of parsing the preamble.
+
+    With externalize, every tikz picture without overlays is compiled
+    once as a standalone graphic, keyed by the hash of its tex, and
+    frames include that graphic instead of the picture.
+
+    With workers, frames are compiled by that many TeX processes kept
+    waiting with the preamble already loaded (Linux only, see
+    WorkerPool). With a cache_dir, the workers stay warm for the next
+    build with the same preamble in this process. A frame taking more
+    than timeout seconds is killed. Workers load the preamble themselves,
+    with precompile_preamble only the other compiles use the format.
+
+    With handout set, the deck is generated as a handout or not, see
+    variant.
+
+    When frames are compiled in pieces, returns the cache key of every
+    frame, which only changes when the frame does.
+    """
+    if Beamer.captured is not None:
+      Beamer.captured.append((self, filepath, dict(
+          compiler=compiler, clean_tex=clean_tex, cache_dir=cache_dir,
+          precompile_preamble=precompile_preamble, externalize=externalize,
+          jobs=jobs, workers=workers, timeout=timeout, handout=handout)))
+      return None
+    if handout is not None:
+      with self.variant(handout):
+        return self.generate_pdf(filepath, compiler=compiler, clean_tex=clean_tex,
+                                 cache_dir=cache_dir, jobs=jobs,
+                                 precompile_preamble=precompile_preamble,
+                                 externalize=externalize, workers=workers,
+                                 timeout=timeout)
+    if cache_dir is None and jobs is None and workers is None:
+      if precompile_preamble or externalize:
+        raise ValueError(
+            "precompile_preamble and externalize need a cache_dir, jobs or workers")
+      workdir, jobname = os.path.split(os.path.abspath(filepath))
+      self.generate_tex(os.path.join(workdir, jobname))
+      compile_until_stable(jobname, workdir, compiler=compiler,
+                           env=input_env(self.input_dirs(filepath)))
+      for ext in ["log"] + (["tex"] if clean_tex else []):
+        try:
+          os.remove(os.path.join(workdir, "%s.%s" % (jobname, ext)))
+        except FileNotFoundError:
+          pass
+      return
+
+    if cache_dir is None:
+      cache_dir = tempfile.mkdtemp()
+      try:
+        return self.generate_pdf(filepath, compiler=compiler, clean_tex=clean_tex,
+                                 cache_dir=cache_dir, jobs=jobs,
+                                 precompile_preamble=precompile_preamble,
+                                 externalize=externalize, workers=workers,
+                                 timeout=timeout)
+      finally:
+        WorkerPool.close_all(os.path.abspath(cache_dir))
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    cache = FrameCache(cache_dir, compiler=compiler,
+                       input_dirs=self.input_dirs(filepath))
+    preamble, sources, skeleton = self.cached_frame_sources(cache, externalize, jobs)
+    keys, _ = self.compile_frames(cache, preamble, sources, skeleton, jobs=jobs,
+                                  precompile_preamble=precompile_preamble,
+                                  workers=workers, timeout=timeout)
+    cache.merge(keys, filepath)
+    if not clean_tex:
+      self.generate_tex(filepath)
+    return keys
+
+  def input_dirs(self, filepath):
+    ## Where relative inputs are found when compiled as a whole
+    return [os.path.dirname(os.path.abspath(filepath)), os.getcwd()]
+
+  def cached_frame_sources(self, cache, externalize=False, jobs=None):
+    """frame_sources, with the pictures externalized into cache if asked."""
+    with self.styled():
+      if not externalize:
+        return self.frame_sources()
+      with self.externalized(
+          PictureExternalizer(cache, self.picture_preamble())) as externalizer:
+        frame_sources = self.frame_sources(externalizer)
+      externalizer.compile(jobs)
+      return frame_sources
+
+  def compile_frames(self, cache, preamble, sources, skeleton, jobs=None,
+                     precompile_preamble=False, workers=None, timeout=None,
+                     toc=None, shared=None):
+    """
+    Compile the frames into cache, and return their keys and the path of
+    the table of contents they used. toc gives a table of contents to
+    use instead of compiling the skeleton for one. shared gives, frame
+    by frame, a key compiled already to use instead, or None.
+    """
+    todo = [i for i in range(len(sources)) if shared is None or shared[i] is None]
+    if len(todo) == 0:
+      return list(shared), toc
+    if precompile_preamble:
+      cache.use_format(preamble)
+    if workers is not None:
+      cache.use_workers(preamble, workers, timeout)
+      ## Keep them all busy
+      jobs = max(jobs or 1, workers)
+    if toc is None and any(self.source_uses_toc(sources[i]) for i in todo):
+      toc = cache.compile_auxiliary(content_hash(skeleton), skeleton, "toc")
+    if toc is not None:
+      with open(toc, encoding="utf-8") as f:
+        toc_content = f.read()
+
+    keys = list(shared) if shared is not None else [None] * len(sources)
+    pieces = []
+    for i in todo:
+      tex = sources[i].dumps(preamble)
+      if self.source_uses_toc(sources[i]):
+        pieces.append((content_hash(tex, toc_content), tex, {"toc": toc}))
+      else:
+        pieces.append((content_hash(tex), tex, None))
+      keys[i] = pieces[-1][0]
+    cache.compile_all(pieces, jobs)
+    return keys, toc
+
+  def generate_pdf_and_handout(self, filepath="default_path",
+                               handout_filepath=None, compiler=None,
+                               clean_tex=True, cache_dir=None,
+                               precompile_preamble=False, externalize=False,
+                               jobs=None, workers=None, timeout=None):
+    """
+    Generate the deck with its overlays into filepath.pdf, and as a
+    handout into handout_filepath.pdf (filepath-handout by default),
+    sharing the work between the two. Options are those of generate_pdf.
+
+    Compiled as a whole, the handout starts from the auxiliary files of
+    the presentation. Compiled in pieces, the document is split and its
+    pictures externalized once, the table of contents is compiled once,
+    and frames without overlays, which render the same in both, are
+    compiled once. The handout only compiles the frames with overlays,
+    against a format of its own with precompile_preamble.
+
+    When frames are compiled in pieces, returns the keys of the frames
+    of both.
+    """
+    if handout_filepath is None:
+      handout_filepath = filepath + "-handout"
+    options = dict(compiler=compiler, clean_tex=clean_tex, cache_dir=cache_dir,
+                   precompile_preamble=precompile_preamble,
+                   externalize=externalize, jobs=jobs, workers=workers,
+                   timeout=timeout)
+    if Beamer.captured is not None or \
+       (cache_dir is None and jobs is None and workers is None):
+      self.generate_pdf(filepath, handout=False, **options)
+      presentation = os.path.abspath(filepath)
+      handout = os.path.abspath(handout_filepath)
+      for ext in RERUN_EXTENSIONS:
+        if os.path.exists("%s.%s" % (presentation, ext)) and \
+           not os.path.exists("%s.%s" % (handout, ext)):
+          shutil.copyfile("%s.%s" % (presentation, ext), "%s.%s" % (handout, ext))
+      self.generate_pdf(handout_filepath, handout=True, **options)
+      return None
+
+    if cache_dir is None:
+      cache_dir = tempfile.mkdtemp()
+      try:
+        options["cache_dir"] = cache_dir
+        return self.generate_pdf_and_handout(filepath, handout_filepath, **options)
+      finally:
+        WorkerPool.close_all(os.path.abspath(cache_dir))
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    cache = FrameCache(cache_dir, compiler=compiler,
+                       input_dirs=self.input_dirs(filepath))
+    with self.variant(False) as documentclass:
+      preamble, sources, skeleton = self.cached_frame_sources(
+          cache, externalize, jobs)
+      keys, toc = self.compile_frames(
+          cache, preamble, sources, skeleton, jobs=jobs,
+          precompile_preamble=precompile_preamble, workers=workers,
+          timeout=timeout)
+    cache.merge(keys, filepath)
+    with self.variant(True) as handout_documentclass:
+      ## Only the class options differ, the tex of every frame is the same
+      handout_preamble = handout_documentclass.dumps() + \
+          preamble[len(documentclass.dumps()):]
+      shared = [None if has_overlays(source.dumps("")) else key
+                for source, key in zip(sources, keys)]
+      handout_keys, _ = self.compile_frames(
+          cache, handout_preamble, sources, skeleton, jobs=jobs,
+          precompile_preamble=precompile_preamble, workers=workers,
+          timeout=timeout, toc=toc, shared=shared)
+    cache.merge(handout_keys, handout_filepath)
+    if not clean_tex:
+      with self.variant(False):
+        self.generate_tex(filepath)
+      with self.variant(True):
+        self.generate_tex(handout_filepath)
+    return keys, handout_keys
 
   def append(self, content):
     self.doc.append(content)
@@ -0,0 +1,150 @@
+import os
+import runpy
+import sys
+import time
+import traceback
+
+from pylatex import StandAloneGraphic
+
+from .pybeamer import Beamer, _find_items
+
+# Rebuild a deck script whenever it or what it reads changes, see
+# python -m pybeamer watch --help
+
+
+class _ReadFiles(object):
+  """
+  Records the files opened while recording is on, through an audit
+  hook, which stays installed for the life of the process.
+  """
+
+  def __init__(self):
+    self.paths = None
+    sys.addaudithook(self.hook)
+
+  def hook(self, event, args):
+    if event == "open" and self.paths is not None and \
+       isinstance(args[0], str) and (args[1] is None or "r" in args[1]):
+      self.paths.add(os.path.abspath(args[0]))
+
+
+class DeckWatcher(object):
+  """
+  Runs a deck script, catching its generate_pdf calls, and builds those
+  decks frame by frame into cache_dir, so that a run only compiles the
+  frames that differ from the ones already in the cache. watch() does
+  so again whenever the script, a local module it imports, a file it
+  reads or an image of the deck changes.
+  """
+
+  def __init__(self, script, cache_dir=None, compiler=None, jobs=None,
+               precompile_preamble=False, externalize=False, interval=0.5):
+    self.script = os.path.abspath(script)
+    self.directory = os.path.dirname(self.script)
+    if cache_dir is None:
+      cache_dir = os.path.join(self.directory, ".pybeamer-cache")
+    self.cache_dir = os.path.abspath(cache_dir)
+    self.compiler = compiler
+    self.jobs = jobs
+    self.precompile_preamble = precompile_preamble
+    self.externalize = externalize
+    self.interval = interval
+    self.reads = _ReadFiles()
+    self.dependencies = {} # path -> (mtime, size) when last run
+    self.frames = {} # output filepath -> frame keys of the last build
+
+  def local_modules(self):
+    ## Modules next to the script, which need to be run again too
+    package = __name__.rsplit(".", 1)[0]
+    for name, module in list(sys.modules.items()):
+      path = getattr(module, "__file__", None)
+      if path is not None and name.split(".")[0] != package and \
+         os.path.abspath(path).startswith(self.directory + os.sep):
+        yield name, os.path.abspath(path)
+
+  def images(self, beamer, filepath):
+    for graphic in _find_items(beamer.document, StandAloneGraphic):
+      name = str(graphic.arguments._positional_args[0])
+      for directory in beamer.input_dirs(filepath):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+          yield os.path.abspath(path)
+
+  def stamp(self, paths):
+    stamps = {}
+    for path in paths:
+      try:
+        status = os.stat(path)
+      except OSError:
+        status = None
+      stamps[path] = None if status is None else (status.st_mtime_ns, status.st_size)
+    return stamps
+
+  def changed(self):
+    return len(self.dependencies) == 0 or \
+      self.stamp(self.dependencies) != self.dependencies
+
+  def run(self):
+    """Run the script once, and return the generate_pdf calls it made."""
+    for name, _ in list(self.local_modules()):
+      del sys.modules[name]
+    captured = []
+    argv, path = sys.argv, list(sys.path)
+    sys.argv = [self.script]
+    sys.path.insert(0, self.directory)
+    Beamer.captured = captured
+    self.reads.paths = set()
+    try:
+      runpy.run_path(self.script, run_name="__main__")
+    finally:
+      read, self.reads.paths = self.reads.paths, None
+      Beamer.captured = None
+      sys.argv, sys.path[:] = argv, path
+      ## Watch whatever was read even if the script failed halfway
+      paths = set([self.script]) | set(path for _, path in self.local_modules())
+      paths |= set(path for path in read if self.is_input(path))
+      for beamer, filepath, _ in captured:
+        paths |= set(self.images(beamer, filepath))
+      self.dependencies = self.stamp(sorted(paths))
+    return captured
+
+  def is_input(self, path):
+    ## Files of the script's own, not of Python or of the cache
+    if not os.path.isfile(path) or path.startswith(self.cache_dir + os.sep) or \
+       "__pycache__" in path.split(os.sep):
+      return False
+    return not any(path.startswith(prefix + os.sep)
+                   for prefix in set([sys.prefix, sys.base_prefix]))
+
+  def build(self):
+    """Run the script and build the decks it generates."""
+    start = time.time()
+    for beamer, filepath, options in self.run():
+      options.update(cache_dir=self.cache_dir,
+                     precompile_preamble=options["precompile_preamble"] or
+                     self.precompile_preamble,
+                     externalize=options["externalize"] or self.externalize)
+      if self.compiler is not None:
+        options["compiler"] = self.compiler
+      if self.jobs is not None:
+        options["jobs"] = self.jobs
+      keys = beamer.generate_pdf(filepath, **options)
+      previous = set(self.frames.get(filepath, []))
+      changed = [i + 1 for i, key in enumerate(keys) if key not in previous]
+      self.frames[filepath] = keys
+      print("%s.pdf: %d frames, %d changed %s(%.1fs)" % (
+          filepath, len(keys), len(changed),
+          ("%s " % changed) if 0 < len(changed) < len(keys) else "",
+          time.time() - start))
+
+  def watch(self):
+    while True:
+      if self.changed():
+        try:
+          self.build()
+        except KeyboardInterrupt:
+          raise
+        except BaseException:
+          ## Keep watching, the next edit may fix it
+          traceback.print_exc()
+      time.sleep(self.interval)